@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Router micro-benchmarks over generated route tables.
+
+For every table size the suite measures matching of known paths through the
+match cache and without it, the cost of a miss, url_for, and the memory the
+table takes per route. Results are written as JSON; with --baseline the run
+is compared against an earlier result file and exits with status 1 when a
+timing regressed by more than --tolerance. Run it as a module from the
+repository root, so the waffle package in the checkout is imported:
+
+    python -m benchmarks.route_bench -o results.json
+    python -m benchmarks.route_bench --baseline results.json
+"""
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from waffle.route import Router
+
+
+SIZES = (10, 100, 1000, 10000)
+RESOURCES = ('users', 'posts', 'orders', 'items', 'files', 'teams', 'tags', 'events')
+TIMINGS = ('match_cached_ns', 'match_uncached_ns', 'miss_ns', 'url_for_ns')
+
+
+def generate_routes(size, seed=0):
+    """
+    Build a route table resembling a real application: about half static
+    pages, the rest int and float placeholder routes under shared prefixes.
+    :return: list of (rule, name, sample path, url_for params)
+    """
+    rnd = random.Random(seed)
+    routes = []
+    for i in range(size):
+        resource = '{}{}'.format(RESOURCES[i % len(RESOURCES)], i // len(RESOURCES))
+        kind = rnd.random()
+        if kind < 0.5:
+            rule = '/{}/about/page{}'.format(resource, i)
+            routes.append((rule, 'r{}'.format(i), rule, {}))
+        elif kind < 0.85:
+            value = rnd.randint(1, 10 ** 6)
+            routes.append(('/{}/<id:int>/detail{}'.format(resource, i), 'r{}'.format(i),
+                           '/{}/{}/detail{}'.format(resource, value, i), {'id': value}))
+        else:
+            value = rnd.randint(1, 10 ** 4) / 8
+            routes.append(('/{}/price/<amount:float>/v{}'.format(resource, i), 'r{}'.format(i),
+                           '/{}/price/{}/v{}'.format(resource, value, i), {'amount': value}))
+    return routes
+
+
+def build_router(routes, cache_size=None):
+    router = Router() if cache_size is None else Router(cache_size=cache_size)
+    for rule, name, _, _ in routes:
+        router.add(rule, None, name=name)
+    return router
+
+
+def per_call_ns(func, args, repeat):
+    """
+    Best of `repeat` passes over args, in nanoseconds per call.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(args) * 1e9
+
+
+def measure_memory(routes):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    router = build_router(routes)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del router
+    return size / len(routes)
+
+
+def run_size(size, lookups, repeat):
+    routes = generate_routes(size)
+    rnd = random.Random(size)
+    sample = [routes[rnd.randrange(size)] for _ in range(lookups)]
+    paths = [path for _, _, path, _ in sample]
+    misses = ['{}/missing'.format(path) for path in paths]
+
+    cached = build_router(routes)
+    for path in paths:
+        cached.match(path)
+    uncached = build_router(routes, cache_size=0)
+    url_for = cached.url_for
+
+    return {
+        'routes': size,
+        'match_cached_ns': per_call_ns(cached.match, paths, repeat),
+        'match_uncached_ns': per_call_ns(uncached.match, paths, repeat),
+        'miss_ns': per_call_ns(uncached.match, misses, repeat),
+        'url_for_ns': per_call_ns(lambda item: url_for(item[1], **item[3]), sample, repeat),
+        'memory_per_route_bytes': measure_memory(routes),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of messages for timings slower than baseline * (1 + tolerance)
+    """
+    previous = {entry['routes']: entry for entry in baseline['results']}
+    regressions = []
+    for entry in results['results']:
+        old = previous.get(entry['routes'])
+        if old is None:
+            continue
+        for key in TIMINGS:
+            if key in old and entry[key] > old[key] * (1 + tolerance):
+                regressions.append('{} routes: {} {:.1f} -> {:.1f}'.format(entry['routes'], key, old[key], entry[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='waffle.route benchmark suite')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES, help='route table sizes')
+    parser.add_argument('-n', '--lookups', type=int, default=20000, help='lookups per measurement')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='passes per measurement, best is kept')
+    parser.add_argument('-o', '--output', help='write JSON here instead of stdout')
+    parser.add_argument('--baseline', help='JSON result file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'lookups': args.lookups,
+        'repeat': args.repeat,
+        'results': [run_size(size, args.lookups, args.repeat) for size in args.sizes],
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print('regression: ' + message, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Compare Router.url_for with building the same links by str.format. Run it
+from the repository root:
+
+    python -m benchmarks.url_for_bench [-n NUMBER]
+"""
+
+import argparse
+import timeit
+
+from waffle.route import Router
+
+
+CASES = (
+    ('static', '/about', '/about', {}),
+    ('int', '/users/<id:int>', '/users/{id}', {'id': 42}),
+    ('mixed', '/shop/<category>/<item:int>/price/<amount:float>', '/shop/{category}/{item}/price/{amount}',
+     {'category': 'books', 'item': 7, 'amount': 9.5}),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='url_for benchmark')
+    parser.add_argument('-n', '--number', type=int, default=200000, help='calls per case')
+    args = parser.parse_args()
+
+    router = Router()
+    for name, rule, _, _ in CASES:
+        router.add(rule, None, name=name)
+
+    print('{:<8} {:>14} {:>14} {:>8}'.format('case', 'url_for ns', 'format ns', 'ratio'))
+    for name, _, fmt, params in CASES:
+        assert router.url_for(name, **params) == fmt.format(**params)
+        routed = timeit.timeit(lambda: router.url_for(name, **params), number=args.number)
+        formatted = timeit.timeit(lambda: fmt.format(**params), number=args.number)
+        print('{:<8} {:>14.1f} {:>14.1f} {:>8.2f}'.format(
+            name, routed / args.number * 1e9, formatted / args.number * 1e9, routed / formatted))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import unittest
+
+from waffle.route import RegexFilter, Router, RouteError
+
+
+class RouterTest(unittest.TestCase):
+    def test_match_typed(self):
+        router = Router()
+        router.add('/users/<id:int>', 'user')
+        router.add('/files/<name>.json', 'json')
+        self.assertEqual(router.match('/users/42')[1], {'id': 42})
+        self.assertEqual(router.match('/files/a.b.json')[1], {'name': 'a.b'})
+        self.assertIsNone(router.match('/users/x'))
+
+    def test_placeholder_names_share_node(self):
+        router = Router()
+        router.add('/b/<x:int>/one', 'one')
+        router.add('/b/<y:int>/two', 'two')
+        self.assertEqual(router.match('/b/5/one')[1], {'x': 5})
+        self.assertEqual(router.match('/b/6/two')[1], {'y': 6})
+
+    def test_same_rule_with_other_name_conflicts(self):
+        router = Router()
+        router.add('/a/<x:int>', 'get')
+        with self.assertRaises(RouteError):
+            router.add('/a/<y:int>', 'post', methods='POST')
+        router.add('/a/<x:int>', 'post', methods='POST')
+        self.assertEqual(router.resolve('POST', '/a/1')[1:], ('post', {'x': 1}))
+
+    def test_url_for(self):
+        router = Router()
+        router.add('/users/<id:int>', 'user', name='user')
+        router.add('/doc/<name>.json', 'doc', name='doc')
+        self.assertEqual(router.url_for('user', id=42), '/users/42')
+        self.assertEqual(router.url_for('user', id=42, q='a b'), '/users/42?q=a+b')
+        self.assertEqual(router.url_for('doc', name='a b'), '/doc/a%20b.json')
+        with self.assertRaises(RouteError):
+            router.url_for('user', id='42')
+        with self.assertRaises(RouteError):
+            router.url_for('doc')
+
+    def test_url_for_checks_regex_filters(self):
+        router = Router()
+        router.add_filter(RegexFilter(r'[0-9]{4}', name='year', to_url='{:04d}'.format))
+        router.add('/re/<v:re:[a-z]+>', 're', name='re')
+        router.add('/archive/<y:year>', 'archive', name='archive')
+        self.assertEqual(router.url_for('re', v='abc'), '/re/abc')
+        self.assertEqual(router.url_for('archive', y=99), '/archive/0099')
+        self.assertEqual(router.match('/archive/0099')[1], {'y': '0099'})
+        for name, params in (('re', {'v': 'A/B'}), ('re', {'v': ''}), ('archive', {'y': 12345})):
+            with self.subTest(name=name, **params):
+                with self.assertRaises(RouteError):
+                    router.url_for(name, **params)
+
+
+if __name__ == '__main__':
+    unittest.main()
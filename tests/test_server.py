@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from waffle.server import BodyDecoder, HTTPParseError, RequestParser, make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def decode_all(data, decoder=None):
+    decoder = decoder or BodyDecoder(chunked=True)
+    buffer = bytearray(data)
+    out = decoder.decode(buffer)
+    return out, decoder
+
+
+class ContentLengthTest(unittest.TestCase):
+    def test_valid(self):
+        decoder = BodyDecoder.from_environ({'CONTENT_LENGTH': '10'})
+        self.assertEqual(decoder.remaining, 10)
+        self.assertFalse(decoder.chunked)
+
+    def test_rejects_non_ascii_and_signed(self):
+        for value in ('\xb2', '٣', '+5', '-1', ' 5', '5 ', '5,5', '0x5', '1_0', '', '9' * 19):
+            with self.subTest(value=value):
+                with self.assertRaises(HTTPParseError) as cm:
+                    BodyDecoder.from_environ({'CONTENT_LENGTH': value})
+                self.assertEqual(cm.exception.status, 400)
+
+    def test_transfer_encoding_with_content_length(self):
+        with self.assertRaises(HTTPParseError) as cm:
+            BodyDecoder.from_environ({'CONTENT_LENGTH': '5', 'HTTP_TRANSFER_ENCODING': 'chunked'})
+        self.assertEqual(cm.exception.status, 400)
+
+    def test_unknown_transfer_encoding(self):
+        with self.assertRaises(HTTPParseError) as cm:
+            BodyDecoder.from_environ({'HTTP_TRANSFER_ENCODING': 'gzip, chunked'})
+        self.assertEqual(cm.exception.status, 501)
+
+
+class ChunkedTest(unittest.TestCase):
+    def test_valid_body(self):
+        out, decoder = decode_all(b'5\r\nhello\r\na;ext=1\r\n0123456789\r\n0\r\nX-Trailer: 1\r\n\r\n')
+        self.assertEqual(out, b'hello0123456789')
+        self.assertTrue(decoder.done)
+
+    def test_uppercase_hex_and_trailing_whitespace(self):
+        out, decoder = decode_all(b'A \r\n0123456789\r\n0\r\n\r\n')
+        self.assertEqual(out, b'0123456789')
+        self.assertTrue(decoder.done)
+
+    def test_incremental(self):
+        decoder, buffer, out = BodyDecoder(chunked=True), bytearray(), b''
+        for byte in b'3\r\nabc\r\n0\r\n\r\n':
+            buffer.append(byte)
+            out += decoder.decode(buffer)
+        self.assertEqual(out, b'abc')
+        self.assertTrue(decoder.done)
+
+    def test_rejects_malformed_sizes(self):
+        for size in (b'0x5', b'+5', b'-5', b'1_0', b' 5', b'', b'g', b'5\xb2', b'1' * 16):
+            with self.subTest(size=size):
+                with self.assertRaises(HTTPParseError) as cm:
+                    decode_all(size + b'\r\nhello\r\n0\r\n\r\n')
+                self.assertEqual(cm.exception.status, 400)
+
+    def test_rejects_missing_data_crlf(self):
+        with self.assertRaises(HTTPParseError):
+            decode_all(b'5\r\nhelloX\r\n0\r\n\r\n')
+
+
+class ParserTest(unittest.TestCase):
+    def test_incomplete_head(self):
+        self.assertIsNone(RequestParser().parse_head(bytearray(b'GET / HTTP/1.1\r\nHost: x\r\n')))
+
+    def test_complete_head(self):
+        buffer = bytearray(b'GET /a?b=1 HTTP/1.1\r\nHost: x\r\n\r\nrest')
+        head, size = RequestParser().parse_head(buffer)
+        self.assertEqual((head.method, head.target, head.version), ('GET', '/a?b=1', 'HTTP/1.1'))
+        self.assertEqual(buffer[size:], b'rest')
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [body]
+
+
+class RecordingLog:
+    """AccessLogger stand-in keeping the logged entries."""
+
+    def __init__(self):
+        self.entries = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def log(self, method, path, protocol, status, size, duration, peer):
+        self.entries.append((method, path, status))
+
+
+class ServerTestCase(unittest.TestCase):
+    def start_server(self, name, app=echo_app, **kwargs):
+        """
+        Run a server in a background thread until the test ends. The evented
+        backend checks its deadlines every 50ms instead of every second.
+        :return: (server, port)
+        """
+        server = make_server(('127.0.0.1', 0), app, name, **kwargs)
+        server.select_timeout = 0.05
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            if hasattr(server, 'shutdown'):
+                server.shutdown()
+                thread.join(5)
+                server.server_close()
+
+        self.addCleanup(stop)
+        return server, server.listen_socket.getsockname()[1]
+
+    def request(self, port, data, timeout=5):
+        """Send raw bytes and read until the server closes the connection."""
+        conn = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+        try:
+            conn.sendall(data)
+            response = b''
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return response
+                response += chunk
+        finally:
+            conn.close()
+
+
+class AccessLogTest(ServerTestCase):
+    def test_unparsed_requests_are_not_logged(self):
+        for name in ('default', 'threaded', 'evented'):
+            with self.subTest(backend=name):
+                log = RecordingLog()
+                _, port = self.start_server(name, access_log=log)
+                self.assertTrue(self.request(port, b'BAD\r\n\r\n').startswith(b'HTTP/1.1 400 '))
+                response = self.request(port, b'POST /bad HTTP/1.0\r\nContent-Length: x\r\n\r\n')
+                self.assertTrue(response.startswith(b'HTTP/1.1 400 '))
+                response = self.request(port, b'POST /ok HTTP/1.0\r\nContent-Length: 2\r\n\r\nok')
+                self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+                self.assertEqual(log.entries, [('POST', '/bad', 400), ('POST', '/ok', 200)])
+
+    def test_shed_requests_are_logged(self):
+        for name in ('default', 'threaded', 'evented'):
+            with self.subTest(backend=name):
+                log = RecordingLog()
+                _, port = self.start_server(name, access_log=log, max_inflight=0)
+                response = self.request(port, b'GET /busy HTTP/1.0\r\n\r\n')
+                self.assertTrue(response.startswith(b'HTTP/1.1 503 '))
+                self.assertEqual(log.entries, [('GET', '/busy', 503)])
+
+
+class LimitsTest(ServerTestCase):
+    BACKENDS = (('threaded', {}), ('evented', {}), ('evented', {'workers': 2}))
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_shedding(self):
+        for name, kwargs in (('threaded', {}), ('evented', {'workers': 2})):
+            with self.subTest(backend=name, **kwargs):
+                release = threading.Event()
+
+                def app(environ, start_response):
+                    release.wait(5)
+                    start_response('200 OK', [('Content-Type', 'text/plain')])
+                    return [b'done']
+
+                server, port = self.start_server(name, app, max_inflight=1, **kwargs)
+                held = socket.create_connection(('127.0.0.1', port), timeout=5)
+                self.addCleanup(held.close)
+                held.sendall(b'GET / HTTP/1.0\r\n\r\n')
+                self.wait_for(lambda: server.get_stats()['inflight'] == 1)
+                self.assertTrue(self.request(port, b'GET / HTTP/1.0\r\n\r\n').startswith(b'HTTP/1.1 503 '))
+                release.set()
+                self.assertTrue(held.recv(4096).startswith(b'HTTP/1.1 200 OK'))
+                self.assertEqual(server.get_stats()['shed'], 1)
+
+    def test_header_timeout(self):
+        for name, kwargs in (('default', {}),) + self.BACKENDS:
+            with self.subTest(backend=name, **kwargs):
+                server, port = self.start_server(name, header_timeout=0.2, **kwargs)
+                response = self.request(port, b'GET / HTTP/1.1\r\nHost: x')
+                self.assertTrue(response.startswith(b'HTTP/1.1 408 '))
+                self.assertEqual(server.get_stats()['header_timeouts'], 1)
+
+    def test_write_timeout(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            if environ['PATH_INFO'] == '/big':
+                return (b'x' * 65536 for _ in range(1024))
+            return [b'ok']
+
+        for name, kwargs in self.BACKENDS:
+            with self.subTest(backend=name, **kwargs):
+                server, port = self.start_server(name, app, max_inflight=1, body_timeout=0.3, **kwargs)
+                stalled = socket.socket()
+                self.addCleanup(stalled.close)
+                stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+                stalled.connect(('127.0.0.1', port))
+                stalled.sendall(b'GET /big HTTP/1.1\r\nHost: x\r\n\r\n')
+                self.wait_for(lambda: server.get_stats().get('write_timeouts') == 1)
+                response = self.request(port, b'GET / HTTP/1.0\r\n\r\n')
+                self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+
+
+class EventLoopErrorTest(ServerTestCase):
+    def test_connection_error_does_not_stop_the_loop(self):
+        class Body:
+            def __iter__(self):
+                return iter([b'partial'])
+
+            def close(self):
+                raise RuntimeError('close failed')
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return Body() if environ['PATH_INFO'] == '/broken' else [b'ok']
+
+        _, port = self.start_server('evented', app)
+        self.request(port, b'GET /broken HTTP/1.0\r\n\r\n')
+        self.assertTrue(self.request(port, b'GET / HTTP/1.0\r\n\r\n').endswith(b'\r\n\r\nok'))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'counts open descriptors through /proc')
+    def test_out_of_file_descriptors(self):
+        code = ('import os, resource\n'
+                'from waffle.server import make_server\n'
+                'def app(environ, start_response):\n'
+                '    start_response("200 OK", [("Content-Type", "text/plain")])\n'
+                '    return [b"ok"]\n'
+                'server = make_server(("127.0.0.1", 0), app, "evented")\n'
+                'server.accept_backoff = 0.05\n'
+                'limit = len(os.listdir("/proc/self/fd")) + 4\n'
+                'resource.setrlimit(resource.RLIMIT_NOFILE, (limit, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))\n'
+                'print(server.listen_socket.getsockname()[1], flush=True)\n'
+                'server.serve_forever()\n')
+        process = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.addCleanup(process.stderr.close)
+        self.addCleanup(process.stdout.close)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        port = int(process.stdout.readline())
+        held = [socket.create_connection(('127.0.0.1', port)) for _ in range(16)]
+        time.sleep(0.3)
+        for conn in held:
+            conn.close()
+        time.sleep(0.3)
+        response = self.request(port, b'GET / HTTP/1.0\r\n\r\n')
+        self.assertTrue(response.endswith(b'\r\n\r\nok'))
+        self.assertIsNone(process.poll())
+
+
+def read_responses(data, methods):
+    """
+    Split raw bytes into responses, framed by Content-Length, chunked
+    encoding or the end of the connection.
+    :param methods: request method of each response, HEAD has no body
+    :return: list of (status, headers dict, body, chunked)
+    """
+    responses = []
+    for method in methods:
+        head, _, data = data.partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        headers = dict(line.split(': ', 1) for line in lines[1:])
+        headers = {name.lower(): value for name, value in headers.items()}
+        chunked = headers.get('transfer-encoding') == 'chunked'
+        if method == 'HEAD':
+            body = b''
+        elif 'content-length' in headers:
+            size = int(headers['content-length'])
+            body, data = data[:size], data[size:]
+        elif chunked:
+            body = b''
+            while True:
+                size_line, _, data = data.partition(b'\r\n')
+                size = int(size_line, 16)
+                body, data = body + data[:size], data[size + 2:]
+                if not size:
+                    break
+        else:
+            body, data = data, b''
+        responses.append((lines[0], headers, body, chunked))
+    return responses, data
+
+
+class KeepAliveTest(ServerTestCase):
+    @staticmethod
+    def app(environ, start_response):
+        path = environ['PATH_INFO']
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        if path == '/stream':
+            return (part for part in (b'a', b'', b'bc'))
+        if path == '/echo':
+            return [environ['wsgi.input'].read()]
+        return [path.encode('latin-1')]
+
+    def test_pipelined_requests(self):
+        requests = (
+            b'GET /first HTTP/1.1\r\nHost: x\r\n\r\n'
+            b'GET /stream HTTP/1.1\r\nHost: x\r\n\r\n'
+            b'HEAD /third HTTP/1.1\r\nHost: x\r\n\r\n'
+            b'POST /echo HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n'
+            b'GET /keep HTTP/1.0\r\nConnection: keep-alive\r\n\r\n'
+            b'GET /stream HTTP/1.0\r\n\r\n'
+            b'GET /never HTTP/1.1\r\nHost: x\r\n\r\n'
+        )
+        methods = ('GET', 'GET', 'HEAD', 'POST', 'GET', 'GET')
+        for name, kwargs in (('threaded', {}), ('evented', {}), ('evented', {'workers': 2})):
+            with self.subTest(backend=name, **kwargs):
+                _, port = self.start_server(name, self.app, **kwargs)
+                responses, rest = read_responses(self.request(port, requests), methods)
+                self.assertEqual(rest, b'')
+                self.assertEqual([status for status, _, _, _ in responses], ['HTTP/1.1 200 OK'] * 6)
+                self.assertEqual([body for _, _, body, _ in responses],
+                                 [b'/first', b'abc', b'', b'abc', b'/keep', b'abc'])
+                self.assertEqual([headers['connection'] for _, headers, _, _ in responses],
+                                 ['keep-alive'] * 5 + ['close'])
+                self.assertEqual([chunked for _, _, _, chunked in responses],
+                                 [False, True, False, False, False, False])
+                self.assertEqual(responses[0][1]['content-length'], '6')
+                self.assertNotIn('content-length', responses[5][1])
+
+    def test_serial_server_closes_after_each_response(self):
+        _, port = self.start_server('default', self.app)
+        data = self.request(port, b'GET /first HTTP/1.1\r\nHost: x\r\n\r\nGET /second HTTP/1.1\r\nHost: x\r\n\r\n')
+        (response,), rest = read_responses(data, ('GET',))
+        self.assertEqual((response[1]['connection'], response[2], rest), ('close', b'/first', b''))
+
+
+class MalformedFramingServerTest(ServerTestCase):
+    """A malformed request is answered with 400 and the server keeps serving."""
+
+    def test_backends(self):
+        bad = (
+            'POST / HTTP/1.1\r\nHost: x\r\nContent-Length: \xb2\r\nConnection: close\r\n\r\n'.encode('latin-1'),
+            b'POST / HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n0x5\r\nhello\r\n0\r\n\r\n',
+        )
+        for name in ('default', 'threaded', 'evented'):
+            with self.subTest(backend=name):
+                _, port = self.start_server(name)
+                for data in bad:
+                    self.assertTrue(self.request(port, data).startswith(b'HTTP/1.1 400 '))
+                response = self.request(port, b'POST / HTTP/1.0\r\nContent-Length: 2\r\n\r\nok')
+                self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+                self.assertTrue(response.endswith(b'\r\n\r\nok'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from multiprocessing import shared_memory
+
+from waffle.util import (Counter, CallTimeout, CountMinSketch, RequestContext, ShardedCounter, SharedCounter,
+                         SpaceSaving, ThreadedDict, timeout, json_dumps, json_dumpb, json_iterencode, json_loads,
+                         parse_http_date)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class CounterTest(unittest.TestCase):
+    def test_counts_elements_not_characters(self):
+        self.assertEqual(Counter(['/a', '/b', '/a']), {'/a': 2, '/b': 1})
+
+    def test_ordering_follows_item_assignment(self):
+        counter = Counter('aab')
+        self.assertEqual(counter.most_common(1), [('a', 2)])
+        counter['b'] += 5
+        self.assertEqual(counter.most_common(1), [('b', 6)])
+        self.assertEqual(counter.least_common(1), [('a', 2)])
+        del counter['b']
+        self.assertEqual(counter.most_common(), [('a', 2)])
+        counter.clear()
+        self.assertEqual(counter.most_common(), [])
+
+    def test_top_n_matches_full_sort(self):
+        counter = Counter({key: key * 7 % 101 for key in range(1000)})
+        self.assertEqual([v for _, v in counter.most_common(10)], [v for _, v in counter.most_common()[:10]])
+        self.assertEqual([v for _, v in counter.least_common(10)], [v for _, v in counter.least_common()[:10]])
+        self.assertEqual(vars(counter), {})
+
+
+def run_forked(func):
+    """Run func in a forked child, exit status 0 when it returned without raising."""
+    pid = os.fork()
+    if not pid:
+        code = 1
+        try:
+            func()
+            code = 0
+        finally:
+            os._exit(code)
+    return os.waitpid(pid, 0)[1]
+
+
+class ShardedCounterTest(unittest.TestCase):
+    def test_threads_sum_exactly(self):
+        counter, drained = ShardedCounter(shards=4), Counter()
+        threads, rounds = 8, 5000
+
+        def work():
+            for _ in range(rounds):
+                counter.increment('a')
+                counter.update(['b', 'b'])
+
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            drained.merge(counter.drain())
+        for worker in workers:
+            worker.join()
+        drained.merge(counter.drain())
+        self.assertEqual(drained, {'a': threads * rounds, 'b': 2 * threads * rounds})
+        self.assertEqual(counter.snapshot(), {})
+
+        for worker in [threading.Thread(target=work) for _ in range(threads)]:
+            worker.start()
+            worker.join()
+        self.assertEqual(counter.snapshot(), {'a': threads * rounds, 'b': 2 * threads * rounds})
+        self.assertEqual(counter['a'], threads * rounds)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'SharedCounter rows are claimed by forked processes')
+class SharedCounterTest(unittest.TestCase):
+    def make_counter(self, slots=4):
+        counter = SharedCounter(['a', 'b'], slots=slots)
+        self.addCleanup(counter.close)
+        return counter
+
+    def test_rows_across_fork(self):
+        counter = self.make_counter()
+        counter.increment('a', 5)
+
+        def child():
+            for _ in range(100):
+                counter.increment('a')
+            counter.merge({'b': 7})
+
+        for _ in range(3):
+            self.assertEqual(run_forked(child), 0)
+        self.assertEqual(counter.snapshot(), {'a': 305, 'b': 21})
+        self.assertEqual(counter['b'], 21)
+
+    def test_dead_process_slot_is_reused(self):
+        counter = self.make_counter(slots=2)
+        counter.increment('a')
+        self.assertEqual(run_forked(lambda: counter.increment('b', 2)), 0)
+        self.assertEqual(run_forked(lambda: counter.increment('b', 3)), 0)
+        self.assertEqual(counter.snapshot(), {'a': 1, 'b': 5})
+
+    def test_close_unlinks_in_owner_only(self):
+        counter = SharedCounter(['a'], slots=2)
+        name = counter._shm.name
+
+        def child():
+            counter.increment('a')
+            counter.close()
+
+        self.assertEqual(run_forked(child), 0)
+        self.assertEqual(counter['a'], 1)
+        counter.close()
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def skewed_stream(seed, size=20000, keys=500):
+    """Weighted (key, value) pairs, a few keys are far more frequent than the rest."""
+    rnd = random.Random(seed)
+    return [(int(rnd.paretovariate(1.2)) % keys, rnd.randint(1, 5)) for _ in range(size)]
+
+
+class SpaceSavingTest(unittest.TestCase):
+    def test_error_bounds(self):
+        sketch, true = SpaceSaving(capacity=50), Counter()
+        for key, value in skewed_stream(1):
+            sketch.increment(key, value)
+            true[key] += value
+            self.assertEqual(sketch._min, min(sketch._counts.values()))
+        self.assertEqual(len(sketch), 50)
+        self.assertEqual(sketch.total, sum(true.values()))
+        bound = sketch.total / sketch.capacity
+        for key, cnt in sketch.most_common():
+            self.assertLessEqual(cnt - sketch.error(key), true[key])
+            self.assertLessEqual(true[key], cnt)
+            self.assertLessEqual(cnt - true[key], bound)
+        for key, cnt in true.items():
+            if cnt > bound:
+                self.assertIn(key, sketch)
+        for key, lower in sketch.guaranteed():
+            self.assertLessEqual(lower, true[key])
+
+    def test_update(self):
+        sketch = SpaceSaving(capacity=2)
+        sketch.update(['a', 'a', 'b'])
+        sketch.update({'c': 5})
+        self.assertEqual(sketch.most_common(), [('c', 6), ('a', 2)])
+        self.assertEqual(sketch.error('c'), 1)
+
+
+class CountMinSketchTest(unittest.TestCase):
+    def test_never_undercounts(self):
+        sketch, true = CountMinSketch(epsilon=0.01, delta=0.01), Counter()
+        for key, value in skewed_stream(2):
+            sketch.increment(key, value)
+            true[key] += value
+        bound = 0.01 * sketch.total
+        within = sum(1 for key, cnt in true.items() if sketch[key] - cnt <= bound)
+        for key, cnt in true.items():
+            self.assertGreaterEqual(sketch[key], cnt)
+        self.assertGreaterEqual(within / len(true), 0.95)
+
+    def test_merge(self):
+        first, second = CountMinSketch(epsilon=0.01, top=3), CountMinSketch(epsilon=0.01, top=3)
+        first.update({'a': 10, 'b': 1})
+        second.update({'a': 5, 'c': 20})
+        first.merge(second)
+        self.assertEqual(first.total, 36)
+        self.assertGreaterEqual(first['a'], 15)
+        self.assertEqual([key for key, _ in first.most_common(2)], ['c', 'a'])
+        with self.assertRaises(ValueError):
+            first.merge(CountMinSketch(epsilon=0.02))
+        with self.assertRaises(ValueError):
+            first.merge(CountMinSketch(epsilon=0.01, delta=0.001))
+
+    def test_top_tracking(self):
+        sketch = CountMinSketch(epsilon=0.001, top=5)
+        heavy = {'heavy{}'.format(i): 1000 + 100 * i for i in range(5)}
+        stream = [(key, 1) for key, cnt in heavy.items() for _ in range(cnt)]
+        stream += [('noise{}'.format(i), 1) for i in range(3000) for _ in range(i % 3 + 1)]
+        random.Random(3).shuffle(stream)
+        for key, value in stream:
+            sketch.increment(key, value)
+        self.assertEqual([key for key, _ in sketch.most_common()], sorted(heavy, key=heavy.get, reverse=True))
+        self.assertEqual(len(list(sketch.elements())), sum(cnt for _, cnt in sketch.most_common()))
+
+
+class TimeoutTest(unittest.TestCase):
+    def test_result_and_expiry(self):
+        @timeout(1)
+        def double(x):
+            return x * 2
+
+        @timeout(0.05)
+        def stuck():
+            time.sleep(0.5)
+
+        self.assertEqual(double(21), 42)
+        with self.assertRaises(CallTimeout) as cm:
+            stuck()
+        self.assertFalse(cm.exception.queued)
+
+    def test_stuck_call_does_not_block_exit(self):
+        code = ('import time\n'
+                'from waffle.util import timeout, CallTimeout\n'
+                'f = timeout(0.1)(lambda: time.sleep(3600))\n'
+                'try:\n'
+                '    f()\n'
+                'except CallTimeout:\n'
+                '    pass\n')
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, timeout=10, check=True)
+
+    def test_inner_timeout_error_is_not_relabelled(self):
+        @timeout(10)
+        def sync_call():
+            raise socket.timeout('inner')
+
+        @timeout(10)
+        async def async_call():
+            raise socket.timeout('inner')
+
+        with self.assertRaises(socket.timeout) as cm:
+            sync_call()
+        self.assertNotIsInstance(cm.exception, CallTimeout)
+        with self.assertRaises(socket.timeout) as cm:
+            asyncio.run(async_call())
+        self.assertNotIsInstance(cm.exception, CallTimeout)
+        with self.assertRaises(socket.timeout) as cm:
+            asyncio.run(sync_call.run_async())
+        self.assertNotIsInstance(cm.exception, CallTimeout)
+
+    def test_async_expiry(self):
+        @timeout(0.05)
+        async def slow():
+            await asyncio.sleep(1)
+
+        with self.assertRaises(CallTimeout):
+            asyncio.run(slow())
+
+
+class JSONTest(unittest.TestCase):
+    def test_dumps_matches_stdlib(self):
+        obj = {'a': [1, 2], 'n': float('nan')}
+        self.assertEqual(json_dumps(obj), '{"a": [1, 2], "n": NaN}')
+
+    def test_bytes_round_trip(self):
+        self.assertEqual(json_loads(json_dumpb({'a': [1, 2]})), {'a': [1, 2]})
+
+    def test_iterencode(self):
+        data = [{'id': i} for i in range(5000)]
+        chunks = list(json_iterencode(data, chunk_size=1024))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json_loads(b''.join(chunks)), data)
+        self.assertEqual(b''.join(json_iterencode(iter([]))), b'[]')
+
+
+class RequestContextTest(unittest.TestCase):
+    def test_namespace_access(self):
+        for cls in (RequestContext, ThreadedDict):
+            with self.subTest(cls=cls.__name__):
+                context = cls()
+                with context.scope():
+                    context.user = 'a'
+                    context['role'] = 'admin'
+                    ns = context.current()
+                    self.assertEqual((ns.user, ns['role'], context.user), ('a', 'admin', 'a'))
+                    self.assertEqual(context.copy(), {'user': 'a', 'role': 'admin'})
+                    self.assertEqual(sorted(context.values()), ['a', 'admin'])
+                    del context.user
+                    with self.assertRaises(AttributeError):
+                        context.user
+                    self.assertEqual(context.get('user', 1), 1)
+                self.assertNotIn('role', context)
+
+    def test_tasks_are_isolated(self):
+        context = ThreadedDict()
+
+        async def handle(i):
+            context.reset()
+            context.value = i
+            await asyncio.sleep(0.01)
+            return context.value
+
+        async def main():
+            return await asyncio.gather(*(handle(i) for i in range(5)))
+
+        self.assertEqual(asyncio.run(main()), list(range(5)))
+
+
+class HTTPDateTest(unittest.TestCase):
+    def test_forms(self):
+        for value in ('Sun, 06 Nov 1994 08:49:37 GMT', 'Sunday, 06-Nov-94 08:49:37 GMT', 'Sun Nov  6 08:49:37 1994'):
+            with self.subTest(value=value):
+                self.assertEqual(parse_http_date(value), 784111777)
+
+    def test_rejects_impossible_dates(self):
+        self.assertEqual(parse_http_date('Tue, 29 Feb 2000 00:00:00 GMT'), 951782400)
+        for value in ('Mon, 31 Feb 2021 00:00:00 GMT', 'Mon, 29 Feb 2021 00:00:00 GMT', 'Fri, 31 Apr 2021 00:00:00 GMT',
+                      'Fri, 00 Apr 2021 00:00:00 GMT', 'Fri, 01 Apr 2021 24:00:00 GMT', 'Thu Feb 30 00:00:00 2021'):
+            with self.subTest(value=value):
+                self.assertIsNone(parse_http_date(value))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,8 +11,9 @@ __status__ = "Internal"
 
 
 def check_environment():
+    import sys
     import platform
-    if platform.python_version_tuple() < ('3', '6') or platform.python_implementation() != 'CPython':
+    if sys.version_info < (3, 6) or platform.python_implementation() != 'CPython':
         raise RuntimeError('Waffle requires CPython 3.6 or greater.')
 
 
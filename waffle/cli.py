@@ -3,9 +3,12 @@
 
 import argparse
 import copy
+import importlib
 import sys
 from . import __version__
 from .util import to_dict, is_ipv4, is_ipv6, get_ip
+from .server import SERVERS, make_server
+from .log import AccessLogger
 
 __all__ = ['serve']
 
@@ -49,14 +52,25 @@ def _get_parser():
     _parser.add_argument('-v', '--version', action='store_true', help='Display version number.')
     _parser.add_argument('-b', '--bind', metavar='ADDRESS', default='0.0.0.0:8080', help='Bind socket to ADDRESS.')
     _parser.add_argument('-s', '--server', metavar='SERVER', default='default', help='Use SERVER as backend.')
+    _parser.add_argument('-w', '--workers', metavar='NUM', type=int, help='Number of worker threads or processes.')
+    _parser.add_argument('-A', '--app', metavar='MODULE:NAME', default='waffle.application:app',
+                         help='Serve WSGI application NAME from MODULE.')
     _parser.add_argument('-p', '--plugin', action=_AppendListAction, help='Install additional plugin.')
     _parser.add_argument('-c', '--conf', metavar='FILE', action=_AppendListAction, help='Load config values from FILE.')
-    _parser.add_argument('-d', '--debug', action='store_true', help='Run server in debug mode.')
+    _parser.add_argument('-d', '--debug', action='store_true', help='Run server in debug mode, dump HTTP heads.')
+    _parser.add_argument('-l', '--access-log', action='store_true', help='Write access log (always on in debug mode).')
+    _parser.add_argument('--log-sample', metavar='RATE', type=float, default=1.0,
+                         help='Fraction of requests written to the access log.')
     _parser.add_argument('-a', '--args', metavar='NAME=VALUE', action=_AppendDictAction, help='Override config values.')
 
     return _parser
 
 
+def _load_app(target):
+    module, _, name = target.partition(':')
+    return getattr(importlib.import_module(module), name or 'app')
+
+
 def serve():
     cmd_parser = _get_parser()
     cmd_args = cmd_parser.parse_args()
@@ -70,7 +84,7 @@ def serve():
         sys.exit(0)
 
     if cmd_args.bind:
-        if not is_ipv4(cmd_args.bind) or not is_ipv6(cmd_args.bind):
+        if not is_ipv4(cmd_args.bind) and not is_ipv6(cmd_args.bind):
             print('Illegal bind address: {}\n'.format(cmd_args.bind))
             cmd_parser.print_help()
             sys.exit(1)
@@ -78,8 +92,15 @@ def serve():
         print('Waffle web bind: {}:{}'.format(_addr, _port))
 
     if cmd_args.server:
+        if cmd_args.server not in SERVERS:
+            print('Unknown server: {}, available: {}\n'.format(cmd_args.server, ', '.join(sorted(SERVERS))))
+            cmd_parser.print_help()
+            sys.exit(1)
         print('Waffle web server: {}'.format(cmd_args.server))
 
+    if cmd_args.workers:
+        print('Waffle web workers: {}'.format(cmd_args.workers))
+
     if cmd_args.plugin:
         print('Waffle web plugins: {}'.format(cmd_args.plugin))
 
@@ -91,3 +112,12 @@ def serve():
 
     if cmd_args.debug:
         print('Debug mode: {}'.format(cmd_args.debug))
+
+    server_options = {'debug': cmd_args.debug}
+    if cmd_args.access_log or cmd_args.debug:
+        server_options['access_log'] = AccessLogger(sample_rate=cmd_args.log_sample)
+    if cmd_args.workers and cmd_args.server != 'default':
+        server_options['workers'] = cmd_args.workers
+    httpd = make_server((_addr, _port), _load_app(cmd_args.app), cmd_args.server, **server_options)
+    print('Waffle web serving on {}:{} ...'.format(_addr, httpd.server_port))
+    httpd.serve_forever()
@@ -2,17 +2,21 @@
 # coding: utf-8
 
 import os
+import queue
+import random
 import inspect
 import logging
 from logging import Formatter
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueListener
 
 
-__all__ = ['get_logger']
+__all__ = ['get_logger', 'AccessLogger']
 
 
 LOG_LEVEL = logging.INFO
 LOG_FILE = os.path.join(os.path.dirname(__file__), '..', 'logs', 'Waffle.log')
+ACCESS_LOG_NAME = 'waffle.access'
+ACCESS_LOG_FORMAT = '{peer} "{method} {path} {protocol}" {status} {bytes} {duration:.3f}ms'
 
 
 class CustomFormatter(Formatter):
@@ -78,3 +82,57 @@ def get_logger(name=None, level=LOG_LEVEL, log_file=LOG_FILE):
         file_handler.setFormatter(CustomFormatter())
         _custom.addHandler(file_handler)
     return _custom
+
+
+class _AccessListener(QueueListener):
+    def __init__(self, access_logger, *handlers):
+        super(_AccessListener, self).__init__(access_logger.queue, *handlers, respect_handler_level=True)
+        self.access_logger = access_logger
+
+    def prepare(self, entry):
+        return self.access_logger.make_record(entry)
+
+
+class AccessLogger:
+    """
+    Structured access log. `log` only puts a tuple on a queue, records are
+    built, formatted and written by a background QueueListener thread so
+    request handling never waits on log I/O. With sample_rate below 1.0 only
+    that fraction of requests is recorded.
+    """
+    FIELDS = ('method', 'path', 'protocol', 'status', 'bytes', 'duration', 'peer')
+
+    def __init__(self, logger=None, sample_rate=1.0, fmt=ACCESS_LOG_FORMAT, handlers=None):
+        self.logger = logger or logging.getLogger(ACCESS_LOG_NAME)
+        self.sample_rate = sample_rate
+        self.fmt = fmt
+        self.handlers = handlers or self.logger.handlers or [logging.StreamHandler()]
+        self.queue = queue.SimpleQueue()
+        self._listener = None
+        self._pid = None
+
+    def start(self):
+        # the listener thread does not survive fork, every process starts its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._listener = _AccessListener(self, *self.handlers)
+            self._listener.start()
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+        self._listener = self._pid = None
+
+    def log(self, method, path, protocol, status, size, duration, peer):
+        """
+        Queue one request. duration is in seconds.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        self.queue.put((method, path, protocol, status, size, duration, peer))
+
+    def make_record(self, entry):
+        fields = dict(zip(self.FIELDS, entry))
+        fields['duration'] *= 1000
+        return self.logger.makeRecord(self.logger.name, logging.INFO, __file__, 0,
+                                      self.fmt.format(**fields), None, None, extra=fields)
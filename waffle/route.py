@@ -3,7 +3,11 @@
 
 
 import re
-from . import WaffleError
+from decimal import Decimal
+from functools import lru_cache
+from urllib.parse import quote, urlencode
+from uuid import UUID
+from . import HTTP_STATUS, ENCODING, WaffleError
 
 
 # Errors ######################################################################
@@ -12,27 +16,537 @@ class RouteError(WaffleError):
     pass
 
 
+CAPTURE_PATT = re.compile(r'([(][?]P<[^>]+>|[(](?![?]))')
+SLUG_CHARS = frozenset('-_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+URL_SAFE_CHARS = SLUG_CHARS | frozenset('.~')
+
+
 class BaseFilter:
+    """
+    Placeholder filter. `to_python` converts the captured text into the value
+    handed to handlers, `to_url` turns a value back into path text.
+    """
+
     def __init__(self, name):
         self.name = name
 
+    def to_python(self, value):
+        return value
+
+    def to_url(self, value):
+        return quote(str(value), safe='')
+
 
 class RegexFilter(BaseFilter):
-    def __init__(self, regexp, *args,  **kwargs):
+    def __init__(self, regexp, *args, segment=True, to_python=None, to_url=None, **kwargs):
+        """
+        :param regexp: pattern for the placeholder value
+        :param segment: False when values may contain slashes
+        :param to_python: optional callable replacing the default conversion
+        :param to_url: optional callable replacing str() as formatting, its
+            text is still checked against regexp and quoted
+        """
         self.regexp = regexp
+        self.segment = segment
+        self.pattern = re.compile(self.format_regex(regexp))
+        if to_python is not None:
+            self.to_python = to_python
+        self.format_value = str if to_url is None else to_url
         super(RegexFilter, self).__init__(*args, **kwargs)
 
     @staticmethod
     def format_regex(regexp):
-        capture_patt = re.compile(r'([(][?]P<[^>]+>|[(](?![?]))')
-        return regexp if '(' not in regexp else capture_patt.sub('(?:', regexp)
+        return regexp if '(' not in regexp else CAPTURE_PATT.sub('(?:', regexp)
+
+    def to_url(self, value):
+        """
+        Format value and check it against regexp before quoting, so the path
+        built is one this filter matches again.
+        """
+        text = self.format_value(value)
+        if self.pattern.fullmatch(text) is None:
+            raise ValueError('{!r} does not match {}'.format(text, self.regexp))
+        return quote(text, safe='' if self.segment else '/')
 
 
 class IntFilter(RegexFilter):
     def __init__(self):
         super(IntFilter, self).__init__(name='int', regexp=r'[+-]?[0-9]+')
 
+    to_python = staticmethod(int)
+
+    @staticmethod
+    def to_url(value):
+        if type(value) is not int:
+            raise TypeError('int expected, got {}'.format(type(value).__name__))
+        return str(value)
+
 
 class FloatFilter(RegexFilter):
     def __init__(self):
         super(FloatFilter, self).__init__(name='float', regexp=r'[+-]?([0-9]*[.])?[0-9]+')
+
+    to_python = staticmethod(float)
+
+    @staticmethod
+    def to_url(value):
+        if type(value) not in (int, float):
+            raise TypeError('float expected, got {}'.format(type(value).__name__))
+        text = repr(float(value))
+        if 'e' in text or 'n' in text:
+            if value != value or value in (float('inf'), float('-inf')):
+                raise ValueError('float must be finite, got {}'.format(text))
+            text = format(Decimal(text), 'f')
+        return text
+
+
+class StrFilter(RegexFilter):
+    def __init__(self):
+        super(StrFilter, self).__init__(name='str', regexp=r'[^/]+')
+
+    @staticmethod
+    def to_url(value):
+        if type(value) is not str or not value:
+            raise TypeError('non-empty str expected, got {!r}'.format(value))
+        return value if URL_SAFE_CHARS.issuperset(value) else quote(value, safe='')
+
+
+class PathFilter(RegexFilter):
+    def __init__(self):
+        super(PathFilter, self).__init__(name='path', regexp=r'.+', segment=False)
+
+    @staticmethod
+    def to_url(value):
+        if type(value) is not str or not value:
+            raise TypeError('non-empty str expected, got {!r}'.format(value))
+        return quote(value, safe='/')
+
+
+class SlugFilter(RegexFilter):
+    def __init__(self):
+        super(SlugFilter, self).__init__(name='slug', regexp=r'[-a-zA-Z0-9_]+')
+
+    @staticmethod
+    def to_url(value):
+        if type(value) is not str or not value or not SLUG_CHARS.issuperset(value):
+            raise ValueError('slug expected, got {!r}'.format(value))
+        return value
+
+
+class UUIDFilter(RegexFilter):
+    def __init__(self):
+        super(UUIDFilter, self).__init__(
+            name='uuid', regexp=r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+    to_python = staticmethod(UUID)
+
+    @staticmethod
+    def to_url(value):
+        return str(value if type(value) is UUID else UUID(value))
+
+
+FILTERS = {}
+
+
+def register_filter(_filter):
+    """
+    Make a filter available to every router created afterwards.
+    :param _filter: BaseFilter instance with a compiled `pattern`
+    :return: the filter, so custom filter instances can be registered inline
+    """
+    if not getattr(_filter, 'pattern', None):
+        raise RouteError('Filter {} has no pattern.'.format(_filter.name))
+    FILTERS[_filter.name] = _filter
+    return _filter
+
+
+for _filter in (StrFilter(), IntFilter(), FloatFilter(), PathFilter(), SlugFilter(), UUIDFilter()):
+    register_filter(_filter)
+del _filter
+
+
+# Router ######################################################################
+###############################################################################
+ROUTE_CACHE_SIZE = 1024
+RULE_PATT = re.compile(r'<([a-zA-Z_][a-zA-Z0-9_]*)(?::([a-zA-Z_][a-zA-Z0-9_]*)(?::([^>]+))?)?>')
+DEFAULT_FILTER = 'str'
+DEFAULT_METHODS = ('GET',)
+
+
+def _error_handler(code):
+    status = HTTP_STATUS[code]
+    body = (status + '\n').encode(ENCODING)
+    headers = [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))]
+
+    def handler(environ, start_response, **params):
+        start_response(status, list(headers))
+        return [body]
+    return handler
+
+
+not_found = _error_handler(404)
+NOT_ALLOWED_STATUS = HTTP_STATUS[405]
+NOT_ALLOWED_BODY = (NOT_ALLOWED_STATUS + '\n').encode(ENCODING)
+NOT_ALLOWED_HEADERS = [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(NOT_ALLOWED_BODY)))]
+
+
+class Route:
+    """
+    A rule with its method table. `handlers` maps explicitly registered
+    methods to handlers, `table` is what dispatch uses: it adds HEAD served by
+    GET and OPTIONS answered with the precomputed `allow` value.
+    """
+
+    def __init__(self, rule, handler, name=None, methods=DEFAULT_METHODS):
+        self.rule = rule
+        self.handler = handler
+        self.name = name
+        self.handlers = {}
+        self.table = {}
+        self.allow = ''
+        self._allow_headers = []
+        # url_for template: (static text, param name, filter) triples, the
+        # last one may carry no param
+        self.template = ()
+        self.params = frozenset()
+        # placeholder names in rule order, matched values are zipped onto them
+        self.keys = ()
+        self.add_methods(methods, handler)
+
+    def __repr__(self):
+        return '<Route {!r} -> {!r}>'.format(self.rule, self.handler)
+
+    def add_methods(self, methods, handler):
+        methods = [method.upper() for method in methods]
+        for method in methods:
+            if method in self.handlers:
+                raise RouteError('Method {} already registered for {}'.format(method, self.rule))
+        for method in methods:
+            self.handlers[method] = handler
+        table = dict(self.handlers)
+        if 'GET' in table:
+            table.setdefault('HEAD', table['GET'])
+        table.setdefault('OPTIONS', self.options)
+        self.table = table
+        self.allow = ', '.join(sorted(table))
+        self._allow_headers = [('Allow', self.allow), ('Content-Length', '0')]
+
+    def options(self, environ, start_response, **params):
+        start_response(HTTP_STATUS[200], list(self._allow_headers))
+        return []
+
+    def not_allowed(self, environ, start_response, **params):
+        start_response(NOT_ALLOWED_STATUS, NOT_ALLOWED_HEADERS + self._allow_headers[:1])
+        return [NOT_ALLOWED_BODY]
+
+
+class _Node:
+    """
+    Radix tree node. `prefix` is the static text consumed by the edge leading
+    here, `children` maps the first character of each static child prefix to
+    the child, `dynamic` holds placeholder children in registration order.
+    """
+    __slots__ = ('prefix', 'children', 'dynamic', 'route', 'param', 'filter', 'pattern', 'segment')
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.children = {}
+        self.dynamic = []
+        self.route = None
+        self.param = None
+        self.filter = None
+        self.pattern = None
+        self.segment = True
+
+
+class Router:
+    """
+    Route table compiled into a radix tree. Static text of all rules shares
+    tree edges and is matched by plain string comparison, filter regexes are
+    only run at placeholder segments such as `<id:int>`. Looking up a path
+    therefore costs O(path length), independent of the number of routes.
+
+    Rules without placeholders are answered from a plain dict first, other
+    results go through a bounded LRU cache keyed by path, so hot URLs skip
+    matching entirely. The cache is cleared whenever a route is added.
+
+    Captured values pass through the filter's `to_python` before they are
+    cached, so handlers receive `<id:int>` as int without parsing it again.
+
+    Dispatch resolves the path once and then looks the method up in the
+    route's table, so HEAD, OPTIONS and 405 answers need no further scan.
+    """
+
+    def __init__(self, cache_size=ROUTE_CACHE_SIZE):
+        self.filters = dict(FILTERS)
+        self.root = _Node()
+        self.routes = []
+        self.static = {}
+        self.names = {}
+        self._cached_match = lru_cache(maxsize=cache_size)(self._match_path)
+
+    @staticmethod
+    def parse_rule(rule):
+        """
+        Split rule into static text and placeholders.
+        :param rule: str, Example: /users/<id:int>/<slug>
+        :return: list of str and (name, filter name, regexp) tuples
+        """
+        tokens, pos = [], 0
+        for match in RULE_PATT.finditer(rule):
+            if match.start() > pos:
+                tokens.append(rule[pos:match.start()])
+            name, filter_name, regexp = match.groups()
+            tokens.append((name, filter_name or DEFAULT_FILTER, regexp))
+            pos = match.end()
+        if pos < len(rule):
+            tokens.append(rule[pos:])
+        return tokens
+
+    def add_filter(self, _filter):
+        """
+        Register a filter for this router only.
+        :param _filter: BaseFilter instance with a compiled `pattern`
+        """
+        if not getattr(_filter, 'pattern', None):
+            raise RouteError('Filter {} has no pattern.'.format(_filter.name))
+        self.filters[_filter.name] = _filter
+        return _filter
+
+    def get_filter(self, filter_name, regexp=None):
+        if filter_name == 're':
+            if not regexp:
+                raise RouteError('Filter re requires a regular expression.')
+            return RegexFilter(name='re', regexp=regexp, segment=False)
+        try:
+            return self.filters[filter_name]
+        except KeyError:
+            raise RouteError('Unknown filter: {}'.format(filter_name))
+
+    def add(self, rule, handler, name=None, methods=DEFAULT_METHODS):
+        """
+        Register handler for rule. Adding a known rule again with other
+        methods extends that route's method table.
+        :param methods: iterable of method names, Example: ('GET', 'POST')
+        :return: Route
+        """
+        if not rule.startswith('/'):
+            raise RouteError('Rule must start with /: {}'.format(rule))
+        if isinstance(methods, str):
+            methods = (methods,)
+        if name is not None and name in self.names and self.names[name].rule != rule:
+            raise RouteError('Route name already registered: {}'.format(name))
+        node, previous, names, keys, template = self.root, None, set(), [], []
+        for token in self.parse_rule(rule):
+            if isinstance(token, str):
+                node = self._insert_static(node, token)
+                template.append([token, None, None])
+            else:
+                if isinstance(previous, tuple):
+                    raise RouteError('Placeholders must be separated by static text: {}'.format(rule))
+                if token[0] in names:
+                    raise RouteError('Duplicate placeholder {} in {}'.format(token[0], rule))
+                names.add(token[0])
+                keys.append(token[0])
+                node = self._insert_dynamic(node, token)
+                if template and template[-1][1] is None:
+                    template[-1][1:] = token[0], node.filter
+                else:
+                    template.append(['', token[0], node.filter])
+            previous = token
+        route = node.route
+        if route is not None:
+            if route.rule != rule:
+                raise RouteError('Rule {} conflicts with {}'.format(rule, route.rule))
+            if name is not None and route.name not in (None, name):
+                raise RouteError('Rule already registered: {}'.format(rule))
+            route.add_methods(methods, handler)
+            if name is not None and route.name is None:
+                route.name = name
+                self.names[name] = route
+            return route
+        node.route = route = Route(rule, handler, name, methods)
+        route.template = tuple(tuple(part) for part in template)
+        route.params = frozenset(names)
+        route.keys = tuple(keys)
+        self.routes.append(route)
+        if name is not None:
+            self.names[name] = route
+        if not names:
+            self.static[rule] = route
+        self._cached_match.cache_clear()
+        return route
+
+    def resolve(self, method, path):
+        """
+        Pick the handler for a request. Unknown paths get a 404 handler,
+        methods outside the route's table a 405 one carrying its Allow.
+        :return: (Route or None, handler, dict of params)
+        """
+        matched = self.match(path)
+        if matched is None:
+            return None, not_found, {}
+        route, params = matched
+        handler = route.table.get(method)
+        if handler is None:
+            handler = route.not_allowed
+        return route, handler, params
+
+    def __call__(self, environ, start_response):
+        """
+        WSGI entry point, handlers are called as
+        handler(environ, start_response, **params).
+        """
+        method = environ['REQUEST_METHOD']
+        route, handler, params = self.resolve(method, environ.get('PATH_INFO') or '/')
+        result = handler(environ, start_response, **params)
+        if method == 'HEAD':
+            return self._discard_body(result)
+        return result
+
+    @staticmethod
+    def _discard_body(result):
+        # run the application up to its first chunk so a lazy start_response
+        # still happens, then drop the body
+        if isinstance(result, (list, tuple)):
+            return []
+        try:
+            for data in result:
+                if data:
+                    break
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return []
+
+    def url_for(self, *args, **params):
+        """
+        Build the path of a named route. Values are checked and formatted by
+        the filters of their placeholders, e.g. `<id:int>` only takes int.
+        Parameters the rule does not use are appended as query string.
+        The route name is taken positionally only, so a placeholder may be
+        called `name` too.
+        :param args: route name given to add()
+        :return: str, Example: url_for('user', id=42) -> /users/42
+        """
+        if len(args) != 1:
+            raise TypeError('url_for() takes the route name as its only positional argument')
+        name = args[0]
+        try:
+            route = self.names[name]
+        except KeyError:
+            raise RouteError('Unknown route name: {}'.format(name)) from None
+        if not params and not route.params:
+            return route.rule
+        parts = []
+        try:
+            for text, key, _filter in route.template:
+                parts.append(text)
+                if key is not None:
+                    parts.append(_filter.to_url(params[key]))
+        except KeyError:
+            raise RouteError('Missing parameter {} for route {}'.format(key, name)) from None
+        except (TypeError, ValueError) as e:
+            raise RouteError('Bad parameter {} for route {}: {}'.format(key, name, e)) from None
+        if len(params) > len(route.params):
+            query = [(k, v) for k, v in params.items() if k not in route.params]
+            return ''.join(parts) + '?' + urlencode(query)
+        return ''.join(parts)
+
+    def cache_info(self):
+        """
+        Statistics of the match cache.
+        :return: functools CacheInfo(hits, misses, maxsize, currsize)
+        """
+        return self._cached_match.cache_info()
+
+    @staticmethod
+    def _insert_static(node, text):
+        while text:
+            child = node.children.get(text[0])
+            if child is None:
+                child = node.children[text[0]] = _Node(text)
+                return child
+            prefix, size = child.prefix, 0
+            limit = min(len(prefix), len(text))
+            while size < limit and prefix[size] == text[size]:
+                size += 1
+            if size < len(prefix):
+                # split the edge at the end of the common prefix
+                middle = _Node(prefix[:size])
+                child.prefix = prefix[size:]
+                middle.children[child.prefix[0]] = child
+                node.children[text[0]] = child = middle
+            node, text = child, text[size:]
+        return node
+
+    def _insert_dynamic(self, node, token):
+        # placeholder names stay with the route, so <x:int> and <y:int> share a node
+        _, filter_name, regexp = token
+        _filter = self.get_filter(filter_name, regexp)
+        param = (filter_name, _filter.pattern.pattern)
+        for child in node.dynamic:
+            if child.param == param:
+                return child
+        child = _Node()
+        child.param = param
+        child.filter = _filter
+        child.pattern = _filter.pattern
+        child.segment = getattr(_filter, 'segment', True)
+        node.dynamic.append(child)
+        return child
+
+    def match(self, path):
+        """
+        Find the route for path.
+        :param path: str
+        :return: (Route, dict of converted params) or None
+        """
+        route = self.static.get(path)
+        if route is not None:
+            return route, {}
+        matched = self._cached_match(path)
+        if matched is None:
+            return None
+        # cached params are shared, hand out a copy
+        return matched[0], dict(matched[1])
+
+    def _match_path(self, path):
+        params = []
+        route = self._match(self.root, path, 0, params)
+        if route is None:
+            return None
+        return route, dict(zip(route.keys, params))
+
+    def _match(self, node, path, pos, params):
+        size = len(path)
+        if pos == size:
+            if node.route is not None:
+                return node.route
+        else:
+            child = node.children.get(path[pos])
+            if child is not None and path.startswith(child.prefix, pos):
+                route = self._match(child, path, pos + len(child.prefix), params)
+                if route is not None:
+                    return route
+        for child in node.dynamic:
+            end = path.find('/', pos) if child.segment else -1
+            if end < 0:
+                end = size
+            fullmatch, children = child.pattern.fullmatch, child.children
+            # inside a segment the placeholder may only stop where a static child
+            # continues, e.g. <name>.json; those win over taking the whole segment
+            stops = [stop for stop in range(end - 1, pos, -1) if path[stop] in children] if children else []
+            stops.append(end)
+            for stop in stops:
+                if fullmatch(path, pos, stop):
+                    try:
+                        value = child.filter.to_python(path[pos:stop])
+                    except ValueError:
+                        continue
+                    params.append(value)
+                    route = self._match(child, path, stop, params)
+                    if route is not None:
+                        return route
+                    params.pop()
+        return None
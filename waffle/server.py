@@ -1,106 +1,1381 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+import re
+import selectors
+import signal
 import socket
+import stat
+import threading
+import time
+from collections import deque, namedtuple
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from urllib.parse import unquote_to_bytes
 import sys
-from . import ENC_CRLF
-from . import application
+from . import HTTP_STATUS, ENC_CRLF, ENC_COLON, ENC_SPACE, ENC_EMPTY, WaffleError
+from .util import Counter, http_date
 
 # Constant ####################################################################
 ###############################################################################
 ENCODING = 'utf-8'
 BUFFER_SIZE = 8192
 RFC_822_DATETIME = '%a, %d %b %Y %H:%M:%S GMT'
+HEADER_ENCODING = 'latin-1'
+SERVER_SOFTWARE = 'WSGIServer 0.2'
+ENC_HTTP_11 = b'HTTP/1.1'
+MAX_LINE_SIZE = 8192
+MAX_HEADER_SIZE = 65536
+MAX_HEADERS = 100
+MAX_BODY_SIZE = 16 * 1024 * 1024
+MAX_DRAIN_SIZE = 65536
+COALESCE_SIZE = 65536
+KEEPALIVE_TIMEOUT = 5.0
+HEADER_TIMEOUT = 10.0
+BODY_TIMEOUT = 30.0
+MAX_KEEPALIVE_REQUESTS = 100
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+HAS_SENDFILE = hasattr(os, 'sendfile')
+HEAD_END_PATT = re.compile(rb'\r\n\r\n')
+LINE_END_PATT = re.compile(rb'\r\n')
+TOKEN_PATT = re.compile(r"^[!#$%&'*+.^_`|~0-9A-Za-z-]+$")
+# ASCII only: str.isdigit and int() also take '²', '+5', '0x5' or '1_0'
+CONTENT_LENGTH_PATT = re.compile(r'[0-9]{1,18}')
+CHUNK_SIZE_PATT = re.compile(rb'[0-9A-Fa-f]{1,15}')
 
 
-# Servers #####################################################################
+# Errors ######################################################################
 ###############################################################################
+class ServerError(WaffleError):
+    pass
 
-class WSGIServer:
-    address_family = socket.AF_INET
-    socket_type = socket.SOCK_STREAM
-    request_queue_size = 1
 
-    def __init__(self, server_address):
-        self.listen_socket = listen_socket = socket.socket(self.address_family, self.socket_type)
-        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listen_socket.bind(server_address)
-        listen_socket.listen(self.request_queue_size)
-        host, port = self.listen_socket.getsockname()[:2]
-        self.server_name = socket.getfqdn(host)
-        self.server_port = port
+class HTTPParseError(ServerError):
+    def __init__(self, status, message=None):
+        self.status = status
+        super(HTTPParseError, self).__init__(message or HTTP_STATUS[status])
+
+
+# Response heads ##############################################################
+###############################################################################
+def encode_header(name, value):
+    return name.encode(HEADER_ENCODING) + ENC_COLON + ENC_SPACE + value.encode(HEADER_ENCODING) + ENC_CRLF
+
+
+STATUS_LINES = {status: ENC_HTTP_11 + ENC_SPACE + status.encode(HEADER_ENCODING) + ENC_CRLF
+                for status in HTTP_STATUS.values()}
+SERVER_HEADER = encode_header('Server', SERVER_SOFTWARE)
+KEEP_ALIVE_HEADER = encode_header('Connection', 'keep-alive')
+CLOSE_HEADER = encode_header('Connection', 'close')
+CHUNKED_HEADER = encode_header('Transfer-Encoding', 'chunked')
+EMPTY_BODY_HEADER = encode_header('Content-Length', '0')
+CONTINUE_RESPONSE = STATUS_LINES[HTTP_STATUS[100]] + ENC_CRLF
+ERROR_RESPONSES = {code: STATUS_LINES[status] + EMPTY_BODY_HEADER + CLOSE_HEADER + ENC_CRLF
+                   for code, status in HTTP_STATUS.items() if code >= 400}
+_date_header = (None, ENC_EMPTY)
+
+
+def status_line(status):
+    line = STATUS_LINES.get(status)
+    if line is None:
+        line = ENC_HTTP_11 + ENC_SPACE + status.encode(HEADER_ENCODING) + ENC_CRLF
+    return line
+
+
+def date_header():
+    """Pre-encoded Date header line, formatted at most once per second."""
+    global _date_header
+    now = int(time.time())
+    second, line = _date_header
+    if second != now:
+        line = encode_header('Date', http_date(now))
+        _date_header = now, line
+    return line
+
+
+def error_response(status):
+    return ERROR_RESPONSES[status]
+
+
+def send_some(sock, buffers):
+    """
+    Send the front of a sequence of buffers with one writev-style call.
+    :return: number of bytes sent
+    """
+    if HAS_SENDMSG:
+        return sock.sendmsg(list(islice(buffers, IOV_MAX)))
+    return sock.send(buffers[0])
+
+
+def consume_buffers(buffers, sent):
+    """Drop sent bytes from the front of a deque of buffers."""
+    while sent:
+        size = len(buffers[0])
+        if sent < size:
+            buffers[0] = memoryview(buffers[0])[sent:]
+            return
+        sent -= size
+        buffers.popleft()
+
+
+def send_buffers(sock, buffers):
+    """
+    Send all buffers on a blocking socket.
+    :return: number of bytes sent
+    """
+    buffers, total = deque(buffers), 0
+    while buffers:
+        sent = send_some(sock, buffers)
+        consume_buffers(buffers, sent)
+        total += sent
+    return total
+
+
+def dump_wire(prefix, lines):
+    sys.stderr.write(''.join('{} {}\n'.format(prefix, line) for line in lines))
+
+
+# Parsing #####################################################################
+###############################################################################
+
+RequestHead = namedtuple('RequestHead', ['method', 'target', 'version', 'headers'])
+
+
+class RequestParser:
+    """
+    Incremental parser for the request line and header block. `parse_head`
+    accepts bytes, bytearray or memoryview and may be called again whenever
+    more bytes arrive; scanning resumes where the previous call stopped and
+    the head is bounded by `max_header_size` and `max_headers`.
+    """
+    max_line_size = MAX_LINE_SIZE
+    max_header_size = MAX_HEADER_SIZE
+    max_headers = MAX_HEADERS
+
+    def __init__(self):
+        self._scanned = 0
+
+    def parse_head(self, buffer):
+        """
+        Parse the head at the start of buffer.
+        :param buffer: bytes-like object
+        :return: (RequestHead, size of head in bytes) or None when incomplete
+        """
+        match = HEAD_END_PATT.search(buffer, max(0, self._scanned - 3))
+        if match is None:
+            self._scanned = len(buffer)
+            if self._scanned > self.max_header_size:
+                raise HTTPParseError(431)
+            if self._scanned > self.max_line_size and LINE_END_PATT.search(buffer) is None:
+                raise HTTPParseError(414)
+            return None
+        self._scanned = 0
+        size = match.end()
+        if size > self.max_header_size:
+            raise HTTPParseError(431)
+        lines = bytes(buffer[:match.start()]).decode(HEADER_ENCODING).split('\r\n')
+        while lines and not lines[0]:
+            # tolerate empty lines left before the request line
+            lines.pop(0)
+        if not lines:
+            raise HTTPParseError(400)
+        if len(lines[0]) > self.max_line_size:
+            raise HTTPParseError(414)
+        if len(lines) - 1 > self.max_headers:
+            raise HTTPParseError(431)
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not TOKEN_PATT.match(parts[0]) or not parts[1]:
+            raise HTTPParseError(400)
+        method, target, version = parts
+        if not version.startswith('HTTP/1.'):
+            raise HTTPParseError(505)
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep or not TOKEN_PATT.match(name):
+                raise HTTPParseError(400)
+            headers.append((name, value.strip(' \t')))
+        return RequestHead(method, target, version, headers), size
+
+
+class BodyDecoder:
+    """
+    Incremental decoder of a request body framed either by Content-Length or
+    by chunked transfer encoding. Encoded bytes are consumed from the front
+    of a bytearray and the decoded payload is returned.
+    """
+    _SIZE, _DATA, _DATA_END, _TRAILER = range(4)
+
+    def __init__(self, length=0, chunked=False):
+        self.chunked = chunked
+        self.remaining = length
+        self.done = not chunked and length == 0
+        self._state = self._SIZE
+
+    @classmethod
+    def from_environ(cls, env):
+        transfer_encoding = env.get('HTTP_TRANSFER_ENCODING')
+        content_length = env.get('CONTENT_LENGTH')
+        if transfer_encoding is not None:
+            if content_length is not None:
+                raise HTTPParseError(400)
+            if transfer_encoding.strip().lower() != 'chunked':
+                raise HTTPParseError(501)
+            return cls(chunked=True)
+        if content_length is not None:
+            if not CONTENT_LENGTH_PATT.fullmatch(content_length):
+                raise HTTPParseError(400)
+            return cls(int(content_length))
+        return cls()
+
+    def decode(self, buffer, size=-1):
+        """
+        Take at most size (all available when negative) body bytes from buffer.
+        :param buffer: bytearray, consumed in place
+        :param size: maximum number of decoded bytes
+        :return: bytes
+        """
+        if self.done:
+            return b''
+        if not self.chunked:
+            count = min(self.remaining, len(buffer)) if size < 0 else min(self.remaining, len(buffer), size)
+            data = bytes(buffer[:count])
+            del buffer[:count]
+            self.remaining -= count
+            self.done = self.remaining == 0
+            return data
+        out = bytearray()
+        while not self.done and (size < 0 or len(out) < size):
+            state = self._state
+            if state == self._DATA:
+                count = min(self.remaining, len(buffer))
+                if size >= 0:
+                    count = min(count, size - len(out))
+                if not count:
+                    break
+                out += buffer[:count]
+                del buffer[:count]
+                self.remaining -= count
+                if not self.remaining:
+                    self._state = self._DATA_END
+                continue
+            if state == self._DATA_END:
+                if len(buffer) < 2:
+                    break
+                if buffer[:2] != b'\r\n':
+                    raise HTTPParseError(400)
+                del buffer[:2]
+                self._state = self._SIZE
+                continue
+            idx = buffer.find(b'\r\n')
+            if idx < 0:
+                if len(buffer) > MAX_LINE_SIZE:
+                    raise HTTPParseError(400)
+                break
+            line = bytes(buffer[:idx])
+            del buffer[:idx + 2]
+            if state == self._TRAILER:
+                self.done = not line
+                continue
+            size_text = line.split(b';', 1)[0].rstrip(b' \t')
+            if not CHUNK_SIZE_PATT.fullmatch(size_text):
+                raise HTTPParseError(400)
+            self.remaining = int(size_text, 16)
+            self._state = self._DATA if self.remaining else self._TRAILER
+        return bytes(out)
+
+
+class RequestInput:
+    """
+    File-like `wsgi.input` reading the request body lazily from the
+    connection, so uploads are never buffered as a whole. Answers
+    `Expect: 100-continue` on the first read.
+    """
+
+    def __init__(self, conn, decoder, expect_continue=False, deadline=None):
+        self.conn = conn
+        self.decoder = decoder
+        self.expect_continue = expect_continue
+        self.deadline = deadline
+        self._buffer = bytearray()
+
+    def _fill(self, size):
+        conn, decoder, buffer = self.conn, self.decoder, self._buffer
+        if self.expect_continue and not decoder.done:
+            self.expect_continue = False
+            conn.cli_conn.sendall(CONTINUE_RESPONSE)
+        while not decoder.done and (size < 0 or len(buffer) < size):
+            data = decoder.decode(conn.in_buffer, size - len(buffer) if size >= 0 else -1)
+            if data:
+                buffer += data
+                continue
+            try:
+                received = conn.receive(None if self.deadline is None else self.deadline - time.monotonic())
+            except socket.timeout:
+                conn.server.count('body_timeouts')
+                conn.keep_alive = False
+                if not conn.headers_sent:
+                    conn.send_error(408)
+                raise
+            if not received:
+                conn.keep_alive = False
+                break
+
+    def _take(self, size):
+        buffer = self._buffer
+        if size < 0 or size >= len(buffer):
+            data = bytes(buffer)
+            buffer.clear()
+        else:
+            data = bytes(buffer[:size])
+            del buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        size = -1 if size is None else size
+        self._fill(size)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        size = -1 if size is None else size
+        buffer = self._buffer
+        start = 0
+        while True:
+            idx = buffer.find(b'\n', start)
+            if idx >= 0:
+                return self._take(idx + 1 if size < 0 else min(idx + 1, size))
+            if 0 <= size <= len(buffer) or self.decoder.done:
+                return self._take(size)
+            start = len(buffer)
+            self._fill(len(buffer) + BUFFER_SIZE)
+
+    def readlines(self, hint=-1):
+        lines, total = [], 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def drain(self, limit=MAX_DRAIN_SIZE):
+        """Discard the unread body, return False when more than limit bytes are left."""
+        self._buffer.clear()
+        decoder = self.decoder
+        while not decoder.done:
+            if not decoder.chunked and decoder.remaining > limit:
+                return False
+            data = self.read(min(BUFFER_SIZE, limit))
+            limit -= len(data)
+            if not data or limit < 0:
+                return decoder.done
+            self._buffer.clear()
+        return True
+
+
+class FileWrapper:
+    """
+    `wsgi.file_wrapper`: iterates a file-like object in blocks of blksize.
+    When it wraps a regular file the server skips iteration and transmits
+    the file with os.sendfile. offset and length select a byte range, by
+    default from the current position to the end of the file.
+    """
+
+    def __init__(self, filelike, blksize=BUFFER_SIZE, offset=None, length=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.offset = offset
+        self.length = length
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def file_range(self):
+        """
+        :return: (file descriptor, offset, count) for os.sendfile or None when not a regular file
+        """
+        try:
+            fd = self.filelike.fileno()
+            st = os.fstat(fd)
+            offset = self.filelike.tell() if self.offset is None else self.offset
+        except (AttributeError, OSError, ValueError):
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        count = max(0, st.st_size - offset)
+        return fd, offset, count if self.length is None else min(count, self.length)
+
+    def __iter__(self):
+        read, remaining = self.filelike.read, self.length
+        if self.offset is not None:
+            self.filelike.seek(self.offset)
+        while remaining is None or remaining > 0:
+            data = read(self.blksize if remaining is None else min(self.blksize, remaining))
+            if not data:
+                return
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+
+# Connections #################################################################
+###############################################################################
+
+class WSGIConnection:
+    """
+    State of one accepted client socket, so that several connections can be
+    served at the same time by one server instance. The connection is kept
+    open between requests (HTTP/1.1 keep-alive) and requests pipelined into
+    the same read are served from `in_buffer` in order.
+    """
+
+    def __init__(self, server, cli_conn, cli_addr):
+        self.server = server
+        self.cli_conn = cli_conn
+        self.cli_addr = cli_addr
+        self.parser = RequestParser()
+        self.in_buffer = bytearray()
+        self.environ = None
+        self.input = None
+        self.request_method = self.path = self.query_string = self.request_version = None
+        self.request_headers = ()
+        self.request_count = 0
+        self.keep_alive = False
         self.headers_set = []
+        self.headers_sent = False
+        self.file_range = None
+        self.started = None
+        self.status = None
+        self.bytes_sent = 0
 
-    def set_app(self, application):
-        self.application = application
+    def handle(self):
+        try:
+            while self.read_request():
+                self.handle_one_request()
+                if not self.keep_alive or not self.input.drain():
+                    break
+        except HTTPParseError as e:
+            self.send_error(e.status)
+            self.log_request()
+        except (socket.timeout, ConnectionError):
+            # logs the 408 of a body timeout, header timeouts have no request to log
+            self.log_request()
+        finally:
+            self.cli_conn.close()
 
-    def serve_forever(self):
-        listen_socket = self.listen_socket
+    def receive(self, timeout=None):
+        """
+        Read once from the socket into `in_buffer`, waiting at most timeout seconds.
+        :return: False when the client closed the connection
+        """
+        if timeout is not None:
+            if timeout <= 0:
+                raise socket.timeout('deadline exceeded')
+            self.cli_conn.settimeout(timeout)
+        data = self.cli_conn.recv(BUFFER_SIZE)
+        if not data:
+            return False
+        self.in_buffer += data
+        return True
+
+    def read_request(self):
+        """
+        Wait up to keepalive_timeout for the next request to start, then up to
+        header_timeout for its complete head, which defeats slowloris clients.
+        The first request of a connection gets header_timeout to start.
+        """
+        server, deadline = self.server, None
+        idle_timeout = server.keepalive_timeout if self.request_count else server.header_timeout
         while True:
-            self.cli_conn, self.cli_addr = listen_socket.accept()
-            self.handle_one_request()
+            parsed = self.parser.parse_head(self.in_buffer)
+            if parsed is not None:
+                break
+            if deadline is None and self.in_buffer:
+                deadline = time.monotonic() + server.header_timeout
+            try:
+                if not self.receive(idle_timeout if deadline is None else deadline - time.monotonic()):
+                    return False
+            except socket.timeout:
+                if deadline is not None:
+                    server.count('header_timeouts')
+                    self.send_error(408)
+                raise
+        head, size = parsed
+        del self.in_buffer[:size]
+        self.start_request(head)
+        env = self.environ
+        self.input = RequestInput(self, BodyDecoder.from_environ(env),
+                                  env.get('HTTP_EXPECT', '').lower() == '100-continue',
+                                  time.monotonic() + server.body_timeout)
+        return True
+
+    def start_request(self, head):
+        self.request_method, target, self.request_version, self.request_headers = head
+        if target.startswith(('http://', 'https://')):
+            target = '/' + target.split('/', 3)[-1] if target.count('/') > 2 else '/'
+        self.path, _, self.query_string = target.partition('?')
+        self.started = time.perf_counter()
+        self.status = None
+        self.bytes_sent = 0
+        if self.server.debug:
+            dump_wire('<', ['{} {} {}'.format(self.request_method, target, self.request_version)] +
+                      ['{}: {}'.format(*header) for header in self.request_headers])
+        self.environ = self.get_environ()
 
     def handle_one_request(self):
-        self.request_data = request_data = self.cli_conn.recv(1024)
-        print(''.join('< {line}\n'.format(line=line) for line in request_data.splitlines()))
-        self.parse_request(request_data)
-        env = self.get_environ()
-        result = self.application(env, self.start_response)
+        server = self.server
+        self.headers_sent = False
+        self.request_count += 1
+        self.keep_alive = self.should_keep_alive()
+        if not server.begin_request():
+            self.keep_alive = False
+            self.send_error(503)
+            self.log_request()
+            return
+        try:
+            self.run_application()
+        except (HTTPParseError, socket.timeout, ConnectionError):
+            raise
+        except Exception as e:
+            # keep the worker alive, one failing request must not end the serve loop
+            print('WSGIServer: error on connection {}: {!r}'.format(self.cli_addr, e), file=sys.stderr)
+            self.keep_alive = False
+            if not self.headers_sent:
+                self.send_error(500)
+                self.log_request()
+        finally:
+            server.end_request()
+
+    def run_application(self):
+        env = self.environ
+        env['wsgi.input'] = self.input
+        result = self.server.application(env, self.start_response)
         self.finish_response(result)
 
-    def parse_request(self, text):
-        request_line = text.splitlines()[0]
-        request_line = request_line.rstrip(ENC_CRLF)
-        (self.request_method, self.path, self.request_version) = request_line.split()
+    def log_request(self):
+        """
+        Log the answer to the current request once. Error responses sent
+        before a request head was parsed are not logged, on every backend.
+        """
+        started, self.started = self.started, None
+        access_log = self.server.access_log
+        if access_log is not None and started is not None and self.status is not None:
+            access_log.log(self.request_method, self.path, self.request_version, self.status, self.bytes_sent,
+                           time.perf_counter() - started, self.cli_addr[0] if self.cli_addr else '-')
+
+    def should_keep_alive(self):
+        if not self.server.keepalive_timeout or self.request_count >= self.server.max_requests:
+            return False
+        connection = self.environ.get('HTTP_CONNECTION', '').lower()
+        if self.request_version == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
 
     def get_environ(self):
+        server = self.server
         env = dict()
         env['wsgi.version'] = (1, 0)
         env['wsgi.url_scheme'] = 'http'
-        env['wsgi.input'] = BytesIO(self.request_data)
         env['wsgi.errors'] = sys.stderr
-        env['wsgi.multithread'] = False
-        env['wsgi.multiprocess'] = False
+        env['wsgi.multithread'] = server.multithread
+        env['wsgi.multiprocess'] = server.multiprocess
         env['wsgi.run_once'] = False
+        env['wsgi.file_wrapper'] = FileWrapper
         env['REQUEST_METHOD'] = self.request_method
-        env['PATH_INFO'] = self.path
-        env['SERVER_NAME'] = self.server_name
-        env['SERVER_PORT'] = str(self.server_port)
+        env['SCRIPT_NAME'] = ''
+        env['PATH_INFO'] = unquote_to_bytes(self.path).decode(HEADER_ENCODING)
+        env['QUERY_STRING'] = self.query_string
+        env['SERVER_NAME'] = server.server_name
+        env['SERVER_PORT'] = str(server.server_port)
+        env['SERVER_PROTOCOL'] = self.request_version
+        if isinstance(self.cli_addr, tuple):
+            env['REMOTE_ADDR'] = self.cli_addr[0]
+            env['REMOTE_PORT'] = str(self.cli_addr[1])
+        for name, value in self.request_headers:
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if key in env:
+                value = '{},{}'.format(env[key], value)
+            env[key] = value
         return env
 
+    def send_error(self, status):
+        self.status = status
+        response = error_response(status)
+        try:
+            self.cli_conn.sendall(response)
+            self.bytes_sent += len(response)
+        except OSError:
+            pass
+
     def start_response(self, status, response_headers, exc_info=None):
-        server_headers = [
-            ('Date', 'Tue, 31 Mar 2015 12:54:48 GMT'),
-            ('Server', 'WSGIServer 0.2')
-        ]
-        self.headers_set = [status, response_headers + server_headers]
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        self.headers_set = [status, response_headers]
+
+    def prepare_response(self, result):
+        """
+        Build the response head as bytes once the application produced its
+        first non-empty chunk, and choose the body framing: the application's
+        Content-Length, a computed one for list or tuple bodies, chunked
+        encoding for other iterables on HTTP/1.1, else close after the body.
+        A FileWrapper around a regular file is left to sendfile, its range is
+        stored in `file_range`.
+        :param result: application iterable
+        :return: (head, iterable of body pieces, each a list of buffers)
+        """
+        self.file_range = file_range = None
+        if HAS_SENDFILE and isinstance(result, FileWrapper):
+            file_range = result.file_range()
+        buffered = isinstance(result, (list, tuple))
+        if file_range is not None:
+            chunks, buffered = (), True
+        elif buffered:
+            chunks = [data.encode(ENCODING) if isinstance(data, str) else data for data in result]
+        else:
+            iterator = iter(result)
+            first = next((data for data in iterator if data), None)
+            chunks = iterator if first is None else chain((first,), iterator)
+            buffered = first is None
+        status, response_headers = self.headers_set
+        names = {name.lower() for name, _ in response_headers}
+        self.status = code = int(status[:3])
+        has_body = self.request_method != 'HEAD' and code >= 200 and code not in (204, 304)
+        chunked = False
+        head = [status_line(status)]
+        if response_headers:
+            head.append(('\r\n'.join(map(': '.join, response_headers)) + '\r\n').encode(HEADER_ENCODING))
+        if 'date' not in names:
+            head.append(date_header())
+        if 'server' not in names:
+            head.append(SERVER_HEADER)
+        if has_body and 'content-length' not in names:
+            if file_range is not None:
+                head.append(b'Content-Length: %d\r\n' % file_range[2])
+            elif buffered:
+                head.append(b'Content-Length: %d\r\n' % sum(map(len, chunks)) if chunks else EMPTY_BODY_HEADER)
+            elif self.request_version == 'HTTP/1.1':
+                head.append(CHUNKED_HEADER)
+                chunked = True
+            else:
+                self.keep_alive = False
+        head.append(KEEP_ALIVE_HEADER if self.keep_alive else CLOSE_HEADER)
+        head.append(ENC_CRLF)
+        self.headers_sent = True
+        if has_body and file_range is not None:
+            self.file_range = file_range
+        return ENC_EMPTY.join(head), self.iter_body(chunks, chunked) if has_body else ()
+
+    @staticmethod
+    def iter_body(chunks, chunked):
+        for data in chunks:
+            if isinstance(data, str):
+                data = data.encode(ENCODING)
+            if not data:
+                continue
+            if chunked:
+                yield [b'%x\r\n' % len(data), data, b'\r\n']
+            else:
+                yield [data]
+        if chunked:
+            yield [b'0\r\n\r\n']
 
     def finish_response(self, result):
+        """
+        Stream the response: the head goes out with the first body chunk and
+        every later chunk is sent as soon as the application yields it. Bodies
+        given as a list are gathered into as few sendmsg calls as possible.
+        """
         try:
-            status, response_headers = self.headers_set
-            response = 'HTTP/1.1 {status}\r\n'.format(status=status)
-            for header in response_headers:
-                response += '{0}: {1}\r\n'.format(*header)
-            response += '\r\n'
-            for data in result:
-                response += data
-            print(''.join('> {line}\n'.format(line=line) for line in response.splitlines()))
-            self.cli_conn.sendall(response)
+            self.cli_conn.settimeout(self.server.body_timeout)
+            head, body = self.prepare_response(result)
+            if self.server.debug:
+                dump_wire('>', head.decode(HEADER_ENCODING).splitlines())
+            gather = isinstance(result, (list, tuple))
+            pending, pending_size = [head], len(head)
+            for pieces in body:
+                pending.extend(pieces)
+                pending_size += sum(map(len, pieces))
+                if not gather or pending_size >= COALESCE_SIZE or len(pending) >= IOV_MAX:
+                    self.bytes_sent += send_buffers(self.cli_conn, pending)
+                    pending, pending_size = [], 0
+            if pending:
+                self.bytes_sent += send_buffers(self.cli_conn, pending)
+            if self.file_range is not None:
+                _, offset, count = self.file_range
+                if count:
+                    # socket.sendfile drives os.sendfile and copes with the socket timeout
+                    self.bytes_sent += self.cli_conn.sendfile(result.filelike, offset, count)
+        except socket.timeout:
+            self.server.count('write_timeouts')
+            raise
         finally:
-            self.cli_conn.close()
+            if hasattr(result, 'close'):
+                result.close()
+            self.log_request()
+
+
+class EventLoopConnection(WSGIConnection):
+    """
+    Non-blocking connection driven by EventLoopWSGIServer. Bytes are parsed as
+    they arrive until a full request (head and decoded body) is read, only then
+    the application runs, and the response is flushed as the socket becomes
+    writable. Kept-alive connections go back to waiting for the next request.
+    """
+
+    def __init__(self, server, cli_conn, cli_addr):
+        super(EventLoopConnection, self).__init__(server, cli_conn, cli_addr)
+        self.out_buffers = deque()
+        self.result = None
+        self.response = None
+        self.decoder = None
+        self.body = bytearray()
+        self.busy = False
+        self.admitted = False
+        self.deadline = None
+        self.last_active = time.monotonic()
+
+    def on_event(self, sock, mask):
+        self.last_active = time.monotonic()
+        if mask & selectors.EVENT_READ:
+            self.on_readable()
+        if mask & selectors.EVENT_WRITE:
+            self.on_writable()
+
+    def on_readable(self):
+        try:
+            data = self.cli_conn.recv(BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.server.close_connection(self)
+            return
+        if not data:
+            self.server.close_connection(self)
+            return
+        self.in_buffer += data
+        self.next_request()
+
+    def next_request(self):
+        try:
+            if self.decoder is None:
+                parsed = self.parser.parse_head(self.in_buffer)
+                if parsed is None:
+                    if self.deadline is None and self.in_buffer:
+                        self.deadline = time.monotonic() + self.server.header_timeout
+                    return
+                head, size = parsed
+                del self.in_buffer[:size]
+                self.start_request(head)
+                self.deadline = time.monotonic() + self.server.body_timeout
+                self.decoder = decoder = BodyDecoder.from_environ(self.environ)
+                if not decoder.chunked and decoder.remaining > self.server.max_body_size:
+                    raise HTTPParseError(413)
+                if not decoder.done and self.environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+                    self.cli_conn.send(CONTINUE_RESPONSE)
+            self.body += self.decoder.decode(self.in_buffer)
+            if len(self.body) > self.server.max_body_size:
+                raise HTTPParseError(413)
+        except HTTPParseError as e:
+            self.fail(e.status)
+            return
+        except OSError:
+            self.server.close_connection(self)
+            return
+        if self.decoder.done:
+            self.input = BytesIO(bytes(self.body))
+            self.decoder = None
+            self.deadline = None
+            self.body = bytearray()
+            self.busy = True
+            self.server.dispatch(self)
+
+    def fail(self, status):
+        """Answer with a pre-encoded error response and close once it is flushed."""
+        self.busy = True
+        self.keep_alive = False
+        self.send_error(status)
+        self.server.wait_writable(self)
+
+    def send_error(self, status):
+        self.status = status
+        self.out_buffers.append(error_response(status))
+
+    def end_request(self):
+        if self.admitted:
+            self.admitted = False
+            self.server.end_request()
+
+    def on_writable(self):
+        buffers, sent = self.out_buffers, 0
+        if not buffers and self.response is not None and not self.server.pull_response(self):
+            return
+        try:
+            if buffers:
+                sent = send_some(self.cli_conn, buffers)
+                consume_buffers(buffers, sent)
+                self.bytes_sent += sent
+            elif self.file_range is not None:
+                sent = self.send_file()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.server.close_connection(self)
+            return
+        if sent:
+            self.deadline = time.monotonic() + self.server.body_timeout
+        if buffers or self.response is not None or self.file_range is not None:
+            return
+        self.deadline = None
+        self.end_request()
+        self.log_request()
+        self.status = None
+        if not self.keep_alive:
+            self.server.close_connection(self)
+            return
+        self.busy = False
+        self.server.wait_readable(self)
+        self.next_request()
+
+    def send_file(self):
+        """:return: number of bytes sent"""
+        fd, offset, count = self.file_range
+        sent = os.sendfile(self.cli_conn.fileno(), fd, offset, count) if count else 0
+        self.bytes_sent += sent
+        if sent and sent < count:
+            self.file_range = fd, offset + sent, count - sent
+            return sent
+        self.file_range = None
+        if sent < count:
+            # file shrank under us, the promised Content-Length cannot be met
+            self.keep_alive = False
+        self.close_response()
+        return sent
+
+    def pull_response(self):
+        """Take body pieces from the application until COALESCE_SIZE bytes are queued."""
+        buffers, size = self.out_buffers, 0
+        try:
+            for pieces in self.response:
+                buffers.extend(pieces)
+                size += sum(map(len, pieces))
+                if size >= COALESCE_SIZE:
+                    return
+        except Exception as e:
+            print('WSGIServer: error on connection {}: {!r}'.format(self.cli_addr, e), file=sys.stderr)
+            self.keep_alive = False
+        self.close_response()
+
+    def close_response(self):
+        result, self.result, self.response, self.file_range = self.result, None, None, None
+        if hasattr(result, 'close'):
+            result.close()
+
+    def handle_one_request(self):
+        # admission against max_inflight happens in EventLoopWSGIServer.dispatch
+        self.headers_sent = False
+        self.request_count += 1
+        self.keep_alive = self.should_keep_alive()
+        try:
+            self.run_application()
+        except Exception as e:
+            print('WSGIServer: error on connection {}: {!r}'.format(self.cli_addr, e), file=sys.stderr)
+            self.close_response()
+            self.keep_alive = False
+            self.status = 500
+            self.out_buffers = deque([error_response(500)])
+
+    def finish_response(self, result):
+        """Queue the head, the body is pulled from the application as the socket drains."""
+        self.result = result
+        head, body = self.prepare_response(result)
+        if self.server.debug:
+            dump_wire('>', head.decode(HEADER_ENCODING).splitlines())
+        self.out_buffers.append(head)
+        self.response = None if self.file_range is not None else iter(body)
+
+
+# Servers #####################################################################
+###############################################################################
+
+class WSGIServer:
+    address_family = socket.AF_INET
+    socket_type = socket.SOCK_STREAM
+    request_queue_size = 1
+    connection_class = WSGIConnection
+    multithread = False
+    multiprocess = False
+    # serial servers close after each response, an idle kept-alive client
+    # would otherwise block everyone else for the whole timeout
+    keepalive_timeout = 0
+
+    def __init__(self, server_address, keepalive_timeout=None, max_requests=MAX_KEEPALIVE_REQUESTS,
+                 access_log=None, debug=False, backlog=None, header_timeout=HEADER_TIMEOUT,
+                 body_timeout=BODY_TIMEOUT, max_inflight=None):
+        """
+        :param keepalive_timeout: seconds an idle connection is kept for its next request, 0 disables
+            keep-alive; defaults to the class attribute
+        :param access_log: waffle.log.AccessLogger, no access log when None
+        :param debug: dump request and response heads to stderr
+        :param backlog: listen backlog, defaults to request_queue_size
+        :param header_timeout: seconds allowed to receive a request head once it started
+        :param body_timeout: seconds allowed to receive a request body, and to send a response
+        :param max_inflight: requests handled at once, further requests get 503
+        """
+        self.server_address = server_address
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.access_log = access_log
+        self.debug = debug
+        if backlog is not None:
+            self.request_queue_size = backlog
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self.listen_socket = self.create_socket(server_address)
+        self.server_activate()
+        host, port = self.listen_socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def create_socket(self, server_address, reuse_port=False):
+        _socket = socket.socket(self.address_family, self.socket_type)
+        _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        _socket.bind(server_address)
+        return _socket
+
+    def server_activate(self):
+        self.listen_socket.listen(self.request_queue_size)
+
+    def set_app(self, application):
+        self.application = application
+
+    def serve_forever(self):
+        listen_socket = self.listen_socket
+        if self.access_log is not None:
+            self.access_log.start()
+        while True:
+            cli_conn, cli_addr = listen_socket.accept()
+            self.process_connection(cli_conn, cli_addr)
+
+    def process_connection(self, cli_conn, cli_addr):
+        self.connection_class(self, cli_conn, cli_addr).handle()
+
+    def count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def begin_request(self):
+        """
+        Admit one request unless max_inflight requests are already running.
+        :return: False when the request has to be shed
+        """
+        with self._stats_lock:
+            if self.max_inflight is not None and self.inflight >= self.max_inflight:
+                self.stats['shed'] += 1
+                return False
+            self.inflight += 1
+            self.stats['requests'] += 1
+            return True
+
+    def end_request(self):
+        with self._stats_lock:
+            self.inflight -= 1
+
+    def get_stats(self):
+        """
+        Counters of this process: requests, shed, header_timeouts, body_timeouts, write_timeouts and
+        current inflight.
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+            stats['inflight'] = self.inflight
+        return stats
+
+    @staticmethod
+    def reject_connection(cli_conn, status):
+        """Best effort pre-encoded error response without blocking, then close."""
+        try:
+            cli_conn.setblocking(False)
+            cli_conn.send(error_response(status))
+        except OSError:
+            pass
+        cli_conn.close()
+
+    def server_close(self):
+        self.listen_socket.close()
+        if self.access_log is not None:
+            self.access_log.stop()
+
+
+class ThreadedWSGIServer(WSGIServer):
+    """
+    Hands accepted connections to a bounded pool of worker threads. When all
+    workers are busy and the pending queue is full, the accept loop blocks and
+    new clients wait in the listen backlog instead of being refused, or, with
+    max_inflight set, they are answered 503 right away.
+    """
+    request_queue_size = 128
+    multithread = True
+    keepalive_timeout = KEEPALIVE_TIMEOUT
+
+    def __init__(self, server_address, workers=32, max_pending=None, **kwargs):
+        super(ThreadedWSGIServer, self).__init__(server_address, **kwargs)
+        self.workers = workers
+        self.max_pending = workers if max_pending is None else max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='waffle-worker')
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+
+    def process_connection(self, cli_conn, cli_addr):
+        if not self._slots.acquire(blocking=self.max_inflight is None):
+            self.count('shed')
+            self.reject_connection(cli_conn, 503)
+            return
+        try:
+            self.executor.submit(self._process_connection, cli_conn, cli_addr)
+        except BaseException:
+            self._slots.release()
+            cli_conn.close()
+            raise
+
+    def _process_connection(self, cli_conn, cli_addr):
+        try:
+            super(ThreadedWSGIServer, self).process_connection(cli_conn, cli_addr)
+        except Exception as e:
+            print('WSGIServer: error on connection {}: {!r}'.format(cli_addr, e), file=sys.stderr)
+        finally:
+            self._slots.release()
+
+    def server_close(self):
+        super(ThreadedWSGIServer, self).server_close()
+        self.executor.shutdown(wait=True)
+
+
+class PreforkWSGIServer(WSGIServer):
+    """
+    Pre-fork master/worker server. The master binds the address, forks
+    `workers` processes which each run the single threaded accept loop, and
+    restarts any worker that exits. With `reuse_port` every worker binds its
+    own SO_REUSEPORT socket so the kernel balances connections between them.
+    """
+    request_queue_size = 128
+    multiprocess = True
+    restart_delay = 1.0
+
+    def __init__(self, server_address, workers=None, reuse_port=False, **kwargs):
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ServerError('SO_REUSEPORT is not supported on this platform.')
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        super(PreforkWSGIServer, self).__init__(server_address, **kwargs)
+        self.children = {}
+        self._running = False
+
+    def create_socket(self, server_address, reuse_port=False):
+        return super(PreforkWSGIServer, self).create_socket(server_address, reuse_port or self.reuse_port)
+
+    def server_activate(self):
+        # with reuse_port the master socket only holds the port, workers listen on their own sockets
+        if not self.reuse_port:
+            super(PreforkWSGIServer, self).server_activate()
+
+    def serve_forever(self):
+        self._running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self.workers):
+            self.spawn_worker()
+        try:
+            while self._running or self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                except InterruptedError:
+                    continue
+                started = self.children.pop(pid, None)
+                if self._running and started is not None:
+                    print('WSGIServer: worker {} exited with status {}, restarting'.format(pid, status),
+                          file=sys.stderr)
+                    if time.monotonic() - started < self.restart_delay:
+                        time.sleep(self.restart_delay)
+                    self.spawn_worker()
+        finally:
+            self.server_close()
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return pid
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+        try:
+            if self.reuse_port:
+                self.listen_socket.close()
+                self.listen_socket = self.create_socket((self.server_address[0], self.server_port))
+                self.listen_socket.listen(self.request_queue_size)
+            super(PreforkWSGIServer, self).serve_forever()
+        except BaseException as e:
+            print('WSGIServer: worker {} failed: {!r}'.format(os.getpid(), e), file=sys.stderr)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _stop(self, signum, frame):
+        self._running = False
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.children.pop(pid, None)
+
+
+class EventLoopWSGIServer(WSGIServer):
+    """
+    Single process server multiplexing all client sockets with `selectors`.
+    Idle and slow clients only cost a buffer each; the application is called
+    once a request has been read completely, either inline in the loop or,
+    when `workers` is set, in a thread pool so slow handlers do not block it.
+    With workers, streamed response bodies are pulled in the pool as well.
+    """
+    request_queue_size = 1024
+    connection_class = EventLoopConnection
+    keepalive_timeout = KEEPALIVE_TIMEOUT
+    max_body_size = MAX_BODY_SIZE
+    select_timeout = 1.0
+    accept_backoff = 0.5
+
+    def __init__(self, server_address, workers=0, **kwargs):
+        super(EventLoopWSGIServer, self).__init__(server_address, **kwargs)
+        self.listen_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.workers = workers
+        self.multithread = bool(workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='waffle-worker') if workers else None
+        self.connections = {}
+        self._ready = deque()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._accept_paused = None
+        self._running = False
+
+    def serve_forever(self):
+        selector = self.selector
+        selector.register(self.listen_socket, selectors.EVENT_READ, self._accept)
+        selector.register(self._wakeup_r, selectors.EVENT_READ, self._wakeup)
+        if self.access_log is not None:
+            self.access_log.start()
+        self._running = True
+        try:
+            while self._running:
+                timeout = self.select_timeout
+                if self._accept_paused is not None:
+                    timeout = max(0, min(timeout, self._accept_paused - time.monotonic()))
+                for key, mask in selector.select(timeout):
+                    try:
+                        key.data(key.fileobj, mask)
+                    except Exception as e:
+                        conn = self.connections.get(key.fileobj)
+                        if conn is None:
+                            raise
+                        # one broken connection must not stop the loop serving all the others
+                        print('WSGIServer: error on connection {}: {!r}'.format(conn.cli_addr, e), file=sys.stderr)
+                        self.close_connection(conn)
+                self.close_idle()
+                if self._accept_paused is not None and self._accept_paused <= time.monotonic():
+                    self._accept_paused = None
+                    selector.register(self.listen_socket, selectors.EVENT_READ, self._accept)
+        finally:
+            if self._accept_paused is None:
+                selector.unregister(self.listen_socket)
+            selector.unregister(self._wakeup_r)
+
+    def shutdown(self):
+        self._running = False
+        self._notify()
+
+    def _accept(self, sock, mask):
+        while True:
+            try:
+                cli_conn, cli_addr = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionError:
+                # ECONNABORTED: the client left before it was accepted
+                continue
+            except OSError as e:
+                # EMFILE, ENFILE, ENOBUFS: stop accepting for a while instead of
+                # spinning on a listen socket that stays readable
+                print('WSGIServer: accept failed: {!r}, pausing for {}s'.format(e, self.accept_backoff),
+                      file=sys.stderr)
+                self.selector.unregister(sock)
+                self._accept_paused = time.monotonic() + self.accept_backoff
+                return
+            cli_conn.setblocking(False)
+            conn = self.connection_class(self, cli_conn, cli_addr)
+            self.connections[cli_conn] = conn
+            self.selector.register(cli_conn, selectors.EVENT_READ, conn.on_event)
+
+    def close_idle(self):
+        """
+        Close kept-alive connections idle for too long and clients missing
+        their deadline: reading a request, or taking the next bytes of a
+        response. Connections parked in the executor are left alone.
+        """
+        now = time.monotonic()
+        idle = now - self.keepalive_timeout
+        registered = self.selector.get_map()
+        for conn in list(self.connections.values()):
+            if conn.deadline is not None:
+                if conn.deadline >= now or conn.cli_conn not in registered:
+                    continue
+                if conn.busy:
+                    self.count('write_timeouts')
+                else:
+                    self.count('header_timeouts' if conn.decoder is None else 'body_timeouts')
+                    try:
+                        conn.bytes_sent += conn.cli_conn.send(error_response(408))
+                    except OSError:
+                        pass
+                    conn.status = 408
+                    conn.log_request()
+                self.close_connection(conn)
+            elif not conn.busy and conn.last_active < idle:
+                self.close_connection(conn)
+
+    def _notify(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _wakeup(self, sock, mask):
+        try:
+            while sock.recv(BUFFER_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._ready:
+            self.wait_writable(self._ready.popleft())
+
+    def dispatch(self, conn):
+        if not self.begin_request():
+            conn.fail(503)
+            return
+        conn.admitted = True
+        self.selector.unregister(conn.cli_conn)
+        if self.executor is None:
+            conn.handle_one_request()
+            self.wait_writable(conn)
+        else:
+            future = self.executor.submit(conn.handle_one_request)
+            future.add_done_callback(lambda _: self._ready.append(conn) or self._notify())
+
+    def pull_response(self, conn):
+        """
+        Get the next body pieces of conn. With workers the application's
+        iterator runs in the pool like the application call itself, so slow
+        generators and file reads do not stall the loop; conn is parked off
+        the selector meanwhile.
+        :return: True when the pieces are queued already
+        """
+        if self.executor is None:
+            conn.pull_response()
+            return True
+        self.selector.unregister(conn.cli_conn)
+        future = self.executor.submit(conn.pull_response)
+        future.add_done_callback(lambda _: self._ready.append(conn) or self._notify())
+        return False
+
+    def wait_readable(self, conn):
+        self.selector.modify(conn.cli_conn, selectors.EVENT_READ, conn.on_event)
+
+    def wait_writable(self, conn):
+        # the client gets body_timeout to take the response, renewed as bytes go out
+        conn.deadline = time.monotonic() + self.body_timeout
+        try:
+            self.selector.modify(conn.cli_conn, selectors.EVENT_WRITE, conn.on_event)
+        except KeyError:
+            self.selector.register(conn.cli_conn, selectors.EVENT_WRITE, conn.on_event)
+
+    def close_connection(self, conn):
+        self.connections.pop(conn.cli_conn, None)
+        conn.end_request()
+        try:
+            conn.close_response()
+        except Exception as e:
+            print('WSGIServer: error on connection {}: {!r}'.format(conn.cli_addr, e), file=sys.stderr)
+        try:
+            self.selector.unregister(conn.cli_conn)
+        except (KeyError, ValueError):
+            pass
+        conn.cli_conn.close()
+
+    def server_close(self):
+        super(EventLoopWSGIServer, self).server_close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+
+SERVERS = {
+    'default': WSGIServer,
+    'threaded': ThreadedWSGIServer,
+    'prefork': PreforkWSGIServer,
+    'evented': EventLoopWSGIServer,
+}
+
+
+def get_server_class(name):
+    try:
+        return SERVERS[name]
+    except KeyError:
+        raise ServerError('Unknown server backend: {}, available: {}'.format(name, ', '.join(sorted(SERVERS))))
 
 
 SERVER_ADDRESS = (HOST, PORT) = '', 8888
 
 
-def make_server(server_address, application):
-    server = WSGIServer(server_address)
+def make_server(server_address, application, server_class=WSGIServer, **kwargs):
+    if isinstance(server_class, str):
+        server_class = get_server_class(server_class)
+    server = server_class(server_address, **kwargs)
     server.set_app(application)
     return server
 
 
 if __name__ == '__main__':
+    from . import application
     httpd = make_server(SERVER_ADDRESS, application.app)
     print('WSGIServer: Serving HTTP on port {port} ...\n'.format(port=PORT))
     httpd.serve_forever()
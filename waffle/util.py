@@ -1,63 +1,127 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
 import re
 import sys
 import io
 import json
 import time
+import math
+import calendar
 import datetime
+from array import array
 from heapq import nlargest, nsmallest
-from multiprocessing import pool, TimeoutError
+import asyncio
+import multiprocessing
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from queue import SimpleQueue
 from operator import itemgetter
-from collections import abc
-from itertools import repeat, chain, starmap
-from functools import wraps
-from threading import local
-from . import RFC_822_DATETIME
+from collections import abc, OrderedDict
+from itertools import repeat, chain, starmap, count, islice
+from functools import wraps, lru_cache, partial
+from threading import local, Lock, Event, BoundedSemaphore, Semaphore, Thread
+from contextlib import contextmanager
+from contextvars import ContextVar
+from . import WaffleError
+
+try:
+    from _collections import _count_elements
+except ImportError:
+    def _count_elements(mapping, iterable):
+        get = mapping.get
+        for elem in iterable:
+            mapping[elem] = get(elem, 0) + 1
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 __all__ = [
-    'exec_in', 'to_str', 'to_bytes', 'to_dict', 'is_ipv4', 'is_ipv6', 'is_port', 'get_ip',
-    'json_dumps', 'json_loads', 'get_file_size', 'squeeze'
+    'exec_in', 'to_str', 'to_bytes', 'to_dict', 'is_ipv4', 'is_ipv6', 'is_port', 'get_ip', 'validate_many',
+    'json_dumps', 'json_dumpb', 'json_loads', 'json_iterencode', 'http_date', 'parse_http_date',
+    'get_file_size', 'squeeze'
 ]
 
 
 # Functions ###################################################################
 ###############################################################################
-def is_ipv4(address):
+ADDRESS_CACHE_SIZE = 4096
+IPV4_PATT = re.compile(
+    r'^(?:(?:2[0-4][0-9]|25[0-5]|[01]?[0-9][0-9]?)[.]){3}(?:2[0-4][0-9]|25[0-5]|[01]?[0-9][0-9]?)$')
+IPV6_PATT = re.compile(
+    '^(?:(?:[0-9A-Fa-f]{1,4}:){6}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|::(?:[0-9A-Fa-f]{1,4}:){5}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:[0-9A-Fa-f]{1,4})?::(?:[0-9A-Fa-f]{1,4}:){4}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4})?::(?:[0-9A-Fa-f]{1,4}:){3}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:(?:[0-9A-Fa-f]{1,4}:){,2}[0-9A-Fa-f]{1,4})?::(?:[0-9A-Fa-f]{1,4}:){2}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:(?:[0-9A-Fa-f]{1,4}:){,3}[0-9A-Fa-f]{1,4})?::[0-9A-Fa-f]{1,4}:(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:(?:[0-9A-Fa-f]{1,4}:){,4}[0-9A-Fa-f]{1,4})?::(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:(?:[0-9A-Fa-f]{1,4}:){,5}[0-9A-Fa-f]{1,4})?::[0-9A-Fa-f]{1,4}|(?:(?:[0-9A-Fa-f]{1,4}:){,6}[0-9A-Fa-f]{1,4})?::)(?:%25(?:[A-Za-z0-9\\-._~]|%[0-9A-Fa-f]{2})+)?$')
+
+
+def _check_ipv4(address):
     _count = address.count(':')
     if _count == 0:
-        patt = re.compile(
-            r'^(?:(?:2[0-4][0-9]|25[0-5]|[01]?[0-9][0-9]?)[.]){3}(?:2[0-4][0-9]|25[0-5]|[01]?[0-9][0-9]?)$')
-        if patt.match(address):
-            return True
-        return False
+        return IPV4_PATT.match(address) is not None
     if _count == 1:
+        host, port = address.split(':', 1)
+        if IPV4_PATT.match(host) is None:
+            return False
         try:
-            host, port = address.split(':', 1)
-            return is_ipv4(host) and 0 <= int(port) <= 65535
+            return 0 <= int(port) <= 65535
         except ValueError:
             return False
     return False
 
 
-def is_ipv6(address):
+def _check_ipv6(address):
     _count = address.count(']:')
     if _count == 0:
-        patt = re.compile(
-            '^(?:(?:[0-9A-Fa-f]{1,4}:){6}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|::(?:[0-9A-Fa-f]{1,4}:){5}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:[0-9A-Fa-f]{1,4})?::(?:[0-9A-Fa-f]{1,4}:){4}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4})?::(?:[0-9A-Fa-f]{1,4}:){3}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:(?:[0-9A-Fa-f]{1,4}:){,2}[0-9A-Fa-f]{1,4})?::(?:[0-9A-Fa-f]{1,4}:){2}(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:(?:[0-9A-Fa-f]{1,4}:){,3}[0-9A-Fa-f]{1,4})?::[0-9A-Fa-f]{1,4}:(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:(?:[0-9A-Fa-f]{1,4}:){,4}[0-9A-Fa-f]{1,4})?::(?:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}|(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))|(?:(?:[0-9A-Fa-f]{1,4}:){,5}[0-9A-Fa-f]{1,4})?::[0-9A-Fa-f]{1,4}|(?:(?:[0-9A-Fa-f]{1,4}:){,6}[0-9A-Fa-f]{1,4})?::)(?:%25(?:[A-Za-z0-9\\-._~]|%[0-9A-Fa-f]{2})+)?$')
-        if patt.match(address):
-            return True
-        return False
+        return IPV6_PATT.match(address) is not None
     if _count == 1 and address.startswith('['):
+        host, port = address.split(']:', 1)
+        if IPV6_PATT.match(host[1:]) is None:
+            return False
         try:
-            host, port = address.split(']:', 1)
-            return is_ipv6(host[1:]) and 0 <= int(port) <= 65535
+            return 0 <= int(port) <= 65535
         except ValueError:
             return False
     return False
 
 
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def is_ipv4(address):
+    return _check_ipv4(address)
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def is_ipv6(address):
+    return _check_ipv6(address)
+
+
+def validate_many(addresses, version=None):
+    """
+    Validate a batch of addresses, e.g. from a log file or an ACL. Repeats
+    inside the batch are checked once; the batch does not go through the
+    per-request caches of is_ipv4 and is_ipv6, so it cannot evict them.
+    :param addresses: iterable of str, with or without port
+    :param version: 4 or 6 to accept only that family, None for both
+    :return: list of bool in input order
+    """
+    if version == 4:
+        check = _check_ipv4
+    elif version == 6:
+        check = _check_ipv6
+    elif version is None:
+        def check(address):
+            return _check_ipv4(address) or _check_ipv6(address)
+    else:
+        raise ValueError('version must be 4, 6 or None')
+    results = {}
+    return [results[address] if address in results else results.setdefault(address, check(address))
+            for address in addresses]
+
+
 def get_ip(address, default='0.0.0.0:8080'):
     if is_ipv4(address):
         host, port = address.split(':', 1)
@@ -100,58 +164,412 @@ def to_dict(_str, pair_sep=',', kv_sep='='):
             [_item.strip().split(kv_sep, 1) for _item in _str.split(pair_sep) if kv_sep in _item]}
 
 
+class JSONBackend:
+    """
+    A JSON implementation: `loads` takes str or bytes, `dumpb` returns
+    UTF-8 bytes. Objects the backend cannot encode fall back to the stdlib.
+    The stdlib backend is the default; 'orjson' is registered when installed
+    and must be selected with use_json_backend, as its output differs: it is
+    compact and encodes NaN and Infinity as null.
+    """
+
+    def __init__(self, name, loads, dumpb):
+        self.name = name
+        self.loads = loads
+        self.dumpb = dumpb
+
+
+JSON_BACKENDS = {}
+JSON_STREAM_BATCH = 1024
+JSON_CHUNK_SIZE = 65536
+_json = None
+
+
+def _stdlib_dumpb(obj):
+    return json.dumps(obj).encode('utf8')
+
+
+def register_json_backend(backend):
+    JSON_BACKENDS[backend.name] = backend
+    return backend
+
+
+def use_json_backend(name):
+    """
+    Select the backend used by the json_* functions.
+    :param name: 'json', 'orjson' or a name given to register_json_backend
+    """
+    global _json
+    try:
+        _json = JSON_BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown JSON backend: {}'.format(name)) from None
+
+
+register_json_backend(JSONBackend('json', json.loads, _stdlib_dumpb))
+use_json_backend('json')
+if orjson is not None:
+    register_json_backend(JSONBackend(
+        'orjson', orjson.loads, partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS)))
+
+
 def json_loads(js):
-    if not isinstance(js, bytes):
-        if isinstance(js, str):
-            return json.loads(js)
+    if not isinstance(js, (bytes, str)):
+        if isinstance(js, (bytearray, memoryview)):
+            return _json.loads(bytes(js))
         raise TypeError
-    return json.loads(to_str(js))
+    return _json.loads(js)
+
+
+def json_dumpb(obj):
+    """
+    Encode obj as UTF-8 JSON bytes, ready to be written to a socket.
+    """
+    try:
+        return _json.dumpb(obj)
+    except TypeError:
+        if _json.dumpb is _stdlib_dumpb:
+            raise
+        return _stdlib_dumpb(obj)
 
 
 def json_dumps(obj):
     return json.dumps(obj)
 
 
+def json_iterencode(obj, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Encode a large array piecewise as bytes chunks of about chunk_size, so a
+    response can be streamed instead of built as one string. Lists, tuples
+    and other non-mapping iterables such as generators are encoded as
+    arrays, JSON_STREAM_BATCH items per backend call; any other object is
+    yielded in one chunk.
+    :return: generator of bytes
+    """
+    if isinstance(obj, (str, bytes, abc.Mapping)) or not isinstance(obj, abc.Iterable):
+        yield json_dumpb(obj)
+        return
+    items = iter(obj)
+    buffer, size, first = [b'['], 1, True
+    while True:
+        batch = list(islice(items, JSON_STREAM_BATCH))
+        if not batch:
+            break
+        data = json_dumpb(batch)[1:-1]
+        if not first:
+            buffer.append(b',')
+        buffer.append(data)
+        size += len(data) + 1
+        first = False
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    buffer.append(b']')
+    yield b''.join(buffer)
+
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+MONTH_NUMBERS = {name.lower(): i for i, name in enumerate(MONTHS, 1)}
+HTTP_DATE_FORMAT = '{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT'
+HTTP_DATE_CACHE_SIZE = 256
+RFC_1123_PATT = re.compile(r'[A-Za-z]{3}, (\d{2}) ([A-Za-z]{3}) (\d{4}) (\d{2}):(\d{2}):(\d{2}) GMT$')
+RFC_850_PATT = re.compile(r'[A-Za-z]{6,9}, (\d{2})-([A-Za-z]{3})-(\d{2}) (\d{2}):(\d{2}):(\d{2}) GMT$')
+ASCTIME_PATT = re.compile(r'[A-Za-z]{3} ([A-Za-z]{3}) ([ \d]\d) (\d{2}):(\d{2}):(\d{2}) (\d{4})$')
+_http_date = (None, '')
+
+
+def _format_http_date(t):
+    return HTTP_DATE_FORMAT.format(WEEKDAYS[t.tm_wday], t.tm_mday, MONTHS[t.tm_mon - 1], t.tm_year,
+                                   t.tm_hour, t.tm_min, t.tm_sec)
+
+
+def http_date(timestamp=None):
+    """
+    IMF-fixdate (RFC 7231) such as 'Sun, 06 Nov 1994 08:49:37 GMT', English
+    names whatever the locale. Repeated calls within one second reuse the
+    last result.
+    :param timestamp: epoch seconds, None for now
+    :return: str
+    """
+    global _http_date
+    second = int(time.time() if timestamp is None else timestamp)
+    cached, text = _http_date
+    if cached == second:
+        return text
+    text = _format_http_date(time.gmtime(second))
+    _http_date = second, text
+    return text
+
+
+@lru_cache(maxsize=HTTP_DATE_CACHE_SIZE)
+def parse_http_date(value):
+    """
+    Parse the three HTTP-date forms: RFC 1123, RFC 850 and asctime. Results
+    are cached, so repeated If-Modified-Since values cost a dict lookup.
+    :param value: str, Example: Sun, 06 Nov 1994 08:49:37 GMT
+    :return: int epoch seconds, None when value is no valid HTTP-date
+    """
+    value = value.strip()
+    match = RFC_1123_PATT.match(value)
+    if match:
+        day, month, year, hour, minute, second = match.groups()
+    else:
+        match = RFC_850_PATT.match(value)
+        if match:
+            day, month, year, hour, minute, second = match.groups()
+            # RFC 7231: two digit years more than 50 years ahead are in the past
+            this_year = time.gmtime().tm_year
+            year = int(year) + this_year // 100 * 100
+            if year > this_year + 50:
+                year -= 100
+        else:
+            match = ASCTIME_PATT.match(value)
+            if not match:
+                return None
+            month, day, hour, minute, second, year = match.groups()
+    month = MONTH_NUMBERS.get(month.lower())
+    year, day, hour, minute, second = int(year), int(day), int(hour), int(minute), int(second)
+    if month is None or hour > 23 or minute > 59 or second > 60:
+        return None
+    if not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return None
+    return calendar.timegm((year, month, day, hour, minute, second))
+
+
 def datetime_to_str(dt=None):
     if isinstance(dt, datetime.datetime):
-        return dt.strftime(RFC_822_DATETIME)
-    elif isinstance(dt, int):
-        return time.strftime(RFC_822_DATETIME, time.gmtime(dt))
+        return _format_http_date(dt.timetuple())
+    elif isinstance(dt, (int, float)):
+        return http_date(dt)
     else:
-        return time.strftime(RFC_822_DATETIME, time.gmtime())
+        return http_date()
 
 
 def str_to_datetime(dt):
-    return time.strptime(dt, RFC_822_DATETIME)
+    """
+    :param dt: HTTP-date in any of its three forms
+    :return: time.struct_time in UTC
+    """
+    timestamp = parse_http_date(dt)
+    if timestamp is None:
+        raise ValueError('Invalid HTTP date: {!r}'.format(dt))
+    return time.gmtime(timestamp)
 
 
-def timeout(max_timeout):
+class CallTimeout(WaffleError, TimeoutError):
     """
-    Timeout decorator, parameter in seconds.
+    Raised by functions wrapped with timeout(). `queued` is True when the
+    call never got a worker in time, i.e. the pool was saturated, rather
+    than the function itself being slow.
+    """
+
+    def __init__(self, func, seconds, queued=False):
+        self.func = func
+        self.seconds = seconds
+        self.queued = queued
+        super(CallTimeout, self).__init__('{} {} after {}s'.format(
+            getattr(func, '__qualname__', func), 'waited for a worker' if queued else 'timed out', seconds))
+
+
+TIMEOUT_WORKERS = 32
+TIMEOUT_MAX_PENDING = 1024
+_timeout_lock = Lock()
+_timeout_executor = None
+_timeout_slots = None
+_timeout_stats = {}
+_cancel_state = local()
+
+
+class _DaemonExecutor:
+    """
+    Bounded pool of daemon threads returning concurrent.futures.Future.
+    Unlike ThreadPoolExecutor, whose workers are joined at interpreter exit,
+    a timed out call that never returns cannot keep the process alive.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._queue = SimpleQueue()
+        self._idle = Semaphore(0)
+        self._lock = Lock()
+        self._threads = 0
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._queue.put((future, fn, args))
+        if not self._idle.acquire(blocking=False):
+            with self._lock:
+                if self._threads < self.max_workers:
+                    self._threads += 1
+                    Thread(target=self._work, daemon=True,
+                           name='{}_{}'.format(self.thread_name_prefix, self._threads)).start()
+        return future
+
+    def _work(self):
+        while True:
+            future, fn, args = self._queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            del future, fn, args
+            self._idle.release()
+
+
+def _get_timeout_executor():
+    global _timeout_executor, _timeout_slots
+    if _timeout_executor is None or _timeout_executor[0] != os.getpid():
+        with _timeout_lock:
+            if _timeout_executor is None or _timeout_executor[0] != os.getpid():
+                _timeout_slots = BoundedSemaphore(TIMEOUT_WORKERS + TIMEOUT_MAX_PENDING)
+                _timeout_executor = os.getpid(), _DaemonExecutor(TIMEOUT_WORKERS, 'waffle-timeout')
+    return _timeout_executor[1], _timeout_slots
+
+
+def _count_timeout(name, value=1):
+    with _timeout_lock:
+        _timeout_stats[name] = _timeout_stats.get(name, 0) + value
+
+
+def timeout_stats():
+    """
+    Counters of the shared timeout pool: submitted, started, finished,
+    timeouts, queued_timeouts (expired before a worker was free), rejected,
+    plus running and pending calls at the time of the call.
+    :return: dict
+    """
+    with _timeout_lock:
+        stats = dict(_timeout_stats)
+    stats.setdefault('started', 0)
+    stats['running'] = stats['started'] - stats.get('finished', 0)
+    stats['pending'] = stats.get('submitted', 0) - stats['started'] - stats.get('cancelled', 0)
+    return stats
+
+
+def cancelled():
+    """
+    Cooperative cancellation hook for functions running under timeout():
+    True once their caller gave up, long loops should check it and return.
+    """
+    event = getattr(_cancel_state, 'event', None)
+    return event is not None and event.is_set()
+
+
+def _run_cancellable(event, func, args, kwargs):
+    _count_timeout('started')
+    _cancel_state.event = event
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _cancel_state.event = None
+        _count_timeout('finished')
+
+
+def _submit(event, func, args, kwargs, seconds, blocking=True):
+    executor, slots = _get_timeout_executor()
+    if not (slots.acquire(timeout=seconds) if blocking else slots.acquire(blocking=False)):
+        _count_timeout('rejected')
+        raise CallTimeout(func, seconds, queued=True)
+    _count_timeout('submitted')
+    future = executor.submit(_run_cancellable, event, func, args, kwargs)
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def _expire(future, event, func, seconds, on_timeout):
+    event.set()
+    queued = future.cancel()
+    if queued:
+        _count_timeout('cancelled')
+        _count_timeout('queued_timeouts')
+    _count_timeout('timeouts')
+    if on_timeout is not None:
+        on_timeout(func, seconds)
+    return CallTimeout(func, seconds, queued=queued)
+
+
+class _InnerTimeout(Exception):
+    def __init__(self, error):
+        super(_InnerTimeout, self).__init__(error)
+        self.error = error
+
+
+async def _guard_timeout(coroutine):
+    # asyncio.TimeoutError is the builtin TimeoutError since 3.11, carry the
+    # coroutine's own ones past wait_for so they are not taken for expiry
+    try:
+        return await coroutine
+    except (TimeoutError, asyncio.TimeoutError) as e:
+        raise _InnerTimeout(e)
+
+
+def timeout(max_timeout, on_timeout=None):
+    """
+    Timeout decorator, parameter in seconds. Calls run on a shared bounded
+    thread pool; when max_timeout passes CallTimeout is raised, the call is
+    dropped if it has not started yet and cancelled() turns True inside it.
+    Coroutine functions are awaited with asyncio.wait_for instead, and plain
+    functions called through the `run_async` attribute run in the pool
+    without blocking the event loop.
     :param max_timeout: seconds to wait
+    :param on_timeout: optional callable(func, max_timeout) run on expiry
     :return: wrapped function result
     """
 
     def timeout_decorator(func):
         """Wrap the original function."""
 
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def coroutine_wrapper(*args, **kwargs):
+                try:
+                    return await asyncio.wait_for(_guard_timeout(func(*args, **kwargs)), max_timeout)
+                except _InnerTimeout as e:
+                    error = e.error
+                except asyncio.TimeoutError:
+                    _count_timeout('timeouts')
+                    if on_timeout is not None:
+                        on_timeout(func, max_timeout)
+                    raise CallTimeout(func, max_timeout) from None
+                # a TimeoutError of the coroutine itself, not our deadline
+                raise error
+
+            return coroutine_wrapper
+
         @wraps(func)
         def func_wrapper(*args, **kwargs):
             """Closure for function."""
-            _pool = pool.ThreadPool(processes=1)
-            async_result = _pool.apply_async(func, args, kwargs)
-            # raises a TimeoutError if execution exceeds max_timeout
+            event, deadline = Event(), time.monotonic() + max_timeout
+            future = _submit(event, func, args, kwargs, max_timeout)
             try:
-                return async_result.get(max_timeout)
-            except TimeoutError:
-                return None
+                return future.result(max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                # the function may have raised a TimeoutError of its own
+                if future.done() and not future.cancelled():
+                    return future.result()
+                raise _expire(future, event, func, max_timeout, on_timeout) from None
+
+        async def run_async(*args, **kwargs):
+            event = Event()
+            future = _submit(event, func, args, kwargs, max_timeout, blocking=False)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), max_timeout)
+            except asyncio.TimeoutError:
+                if future.done() and not future.cancelled():
+                    return future.result()
+                raise _expire(future, event, func, max_timeout, on_timeout) from None
 
+        func_wrapper.run_async = run_async
         return func_wrapper
 
     return timeout_decorator
 
 
-
 def find_dict_key(obj, val):
     """
     Find all key for given value
@@ -197,14 +615,56 @@ def unique_list(obj, key=None):
     :param key: key function
     :return: list
     """
-    checked = []
+    return list(iter_unique(obj, key))
+
+
+def iter_unique(obj, key=None, capacity=None, error_rate=0.001, window=None, clock=time.monotonic):
+    """
+    Yield the elements of obj lazily, skipping ones whose key was seen.
+    By default seen keys are kept exactly. With `capacity` they go into a
+    fixed size BloomFilter instead: memory stays constant, and about
+    error_rate of the unique elements are wrongly dropped once capacity keys
+    were seen. With `window` a key only counts as seen for that many seconds
+    of `clock` after its first occurrence, memory then follows the number of
+    keys in one window.
+    :param obj: iterable
+    :param key: key function
+    :return: generator
+    """
+    if capacity is not None and window is not None:
+        raise ValueError('capacity and window cannot be combined')
+    if window is not None:
+        yield from _iter_unique_window(obj, key, window, clock)
+        return
+    if capacity is not None:
+        seen = BloomFilter(capacity, error_rate)
+        add = seen.add
+        for e in obj:
+            if add(key(e) if key else e):
+                yield e
+        return
     seen = set()
+    add = seen.add
     for e in obj:
         _e = key(e) if key else e
         if _e not in seen:
-            checked.append(e)
-            seen.add(_e)
-    return checked
+            add(_e)
+            yield e
+
+
+def _iter_unique_window(obj, key, window, clock):
+    seen = OrderedDict()
+    for e in obj:
+        _e = key(e) if key else e
+        expired = clock() - window
+        while seen:
+            oldest, stamp = next(iter(seen.items()))
+            if stamp > expired:
+                break
+            del seen[oldest]
+        if _e not in seen:
+            seen[_e] = expired + window
+            yield e
 
 
 def requeue_list(obj, idx):
@@ -376,6 +836,12 @@ class ObjectDict(dict):
 class Counter(dict):
     """
     Counter class implemented by dict.
+
+    Iterables are counted into a plain dict by the C helper of collections and
+    then merged, so bulk updates cost one Python step per distinct key rather
+    than per element. most_common(n) and least_common(n) select with a heap
+    in O(len * log n) instead of sorting every count, and item assignment
+    stays plain dict, as there is nothing to invalidate.
     """
 
     def __init__(self, *args, **kwargs):
@@ -392,22 +858,31 @@ class Counter(dict):
         raise NotImplementedError(
             'Counter.fromkeys() is undefined.  Use Counter(iterable) instead.')
 
+    def _merge(self, counts, sign=1):
+        if not self and sign > 0:
+            dict.update(self, counts)
+            return
+        get, setitem = self.get, dict.__setitem__
+        if sign > 0:
+            for elem, cnt in counts.items():
+                setitem(self, elem, get(elem, 0) + cnt)
+        else:
+            for elem, cnt in counts.items():
+                setitem(self, elem, get(elem, 0) - cnt)
+
     def update(self, *args, **kwargs):
         if len(args) > 1:
             raise TypeError('expected at most 1 arguments, got {}'.format(len(args)))
         iterable = args[0] if args else None
         if iterable is not None:
             if isinstance(iterable, abc.Mapping):
-                if self:
-                    for elem, cnt in iterable.items():
-                        self[elem] += cnt
-                else:
-                    super(Counter, self).update(iterable)
+                self._merge(iterable)
             else:
-                for elem in str(iterable):
-                    self[elem] += 1
+                counts = {}
+                _count_elements(counts, iterable)
+                self._merge(counts)
         if kwargs:
-            self.update(kwargs)
+            self._merge(kwargs)
 
     def subtract(self, *args, **kwargs):
         if len(args) > 1:
@@ -415,14 +890,37 @@ class Counter(dict):
         iterable = args[0] if args else None
         if iterable is not None:
             if isinstance(iterable, abc.Mapping):
-                if self:
-                    for elem, cnt in iterable.items():
-                        self[elem] -= cnt
+                self._merge(iterable, -1)
             else:
-                for elem in str(iterable):
-                    self[elem] -= 1
+                counts = {}
+                _count_elements(counts, iterable)
+                self._merge(counts, -1)
         if kwargs:
-            self.subtract(kwargs)
+            self._merge(kwargs, -1)
+
+    def update_batches(self, batches):
+        """
+        Count several batches of elements, merging into the counter once.
+        :param batches: iterable of iterables, Example: chunks read from a queue
+        :return: self
+        """
+        counts = {}
+        for batch in batches:
+            _count_elements(counts, batch)
+        self._merge(counts)
+        return self
+
+    def merge(self, *counters):
+        """
+        Add the counts of many mappings in one pass.
+        :param counters: Counter or other mappings of element to count
+        :return: self
+        """
+        get, setitem = self.get, dict.__setitem__
+        for counter in counters:
+            for elem, cnt in counter.items():
+                setitem(self, elem, get(elem, 0) + cnt)
+        return self
 
     def most_common(self, n=None):
         if n is None:
@@ -515,28 +1013,454 @@ class Counter(dict):
         return result
 
 
-class ThreadedDict(local):
-    _instances = set()
+class ShardedCounter:
+    """
+    Thread safe counter striped over `shards` Counters, each behind its own
+    lock. Every thread is pinned to one shard on first use, so increments from
+    different threads rarely meet on the same lock; reads merge all shards.
+    """
+
+    def __init__(self, shards=16):
+        self._shards = [(Lock(), Counter()) for _ in range(shards)]
+        self._next = count()
+        self._local = local()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._shards[next(self._next) % len(self._shards)]
+            return shard
+
+    def increment(self, key, value=1):
+        lock, counter = self._shard()
+        with lock:
+            counter[key] += value
+
+    def update(self, *args, **kwargs):
+        lock, counter = self._shard()
+        with lock:
+            counter.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        total = 0
+        for lock, counter in self._shards:
+            with lock:
+                total += counter[key]
+        return total
+
+    def snapshot(self):
+        """
+        :return: Counter with the totals of all shards
+        """
+        result = Counter()
+        for lock, counter in self._shards:
+            with lock:
+                result.merge(counter)
+        return result
+
+    def drain(self):
+        """
+        Take the totals and reset every shard, e.g. once per metrics interval.
+        :return: Counter
+        """
+        result = Counter()
+        for lock, counter in self._shards:
+            with lock:
+                result.merge(counter)
+                counter.clear()
+        return result
+
+    def most_common(self, n=None):
+        return self.snapshot().most_common(n)
 
-    def __init__(self):
-        ThreadedDict._instances.add(self)
+    def clear(self):
+        for lock, counter in self._shards:
+            with lock:
+                counter.clear()
 
-    def __del__(self):
-        ThreadedDict._instances.remove(self)
 
-    def __hash__(self):
-        return id(self)
+class SharedCounter:
+    """
+    Counter over a fixed set of keys in a multiprocessing.shared_memory block,
+    shared by processes forked after it was created. Each process owns one
+    row of int64 cells and is its only writer, so increments take no cross
+    process lock; snapshot() adds up the rows. A row keeps its counts after
+    its process exits and is reused by the next process claiming a slot.
+    """
+
+    def __init__(self, keys, slots=64):
+        """
+        :param keys: iterable of hashable keys, fixed for the counter's life
+        :param slots: max number of processes writing at the same time
+        """
+        if shared_memory is None:
+            raise RuntimeError('SharedCounter requires multiprocessing.shared_memory.')
+        self.keys = tuple(keys)
+        self.index = {key: i + 1 for i, key in enumerate(self.keys)}
+        self.slots = slots
+        self._width = len(self.keys) + 1
+        self._shm = shared_memory.SharedMemory(create=True, size=8 * self._width * slots)
+        self._cells = self._shm.buf.cast('q')
+        for i in range(len(self._cells)):
+            self._cells[i] = 0
+        self._claim_lock = multiprocessing.Lock()
+        self._lock = Lock()
+        self._owner = os.getpid()
+        self._pid = None
+        self._row = 0
+
+    def _claim(self):
+        pid, cells, width = os.getpid(), self._cells, self._width
+        with self._claim_lock:
+            if self._pid == pid:
+                return self._row
+            # new process: the thread lock may have been copied while held
+            self._lock = Lock()
+            free = None
+            for slot in range(self.slots):
+                owner = cells[slot * width]
+                if owner == pid:
+                    free = slot
+                    break
+                if free is None and (owner == 0 or not self._alive(owner)):
+                    free = slot
+            if free is None:
+                raise RuntimeError('SharedCounter has no free slot for process {}.'.format(pid))
+            cells[free * width] = pid
+        self._pid, self._row = pid, free * width
+        return self._row
 
     @staticmethod
-    def clear_all():
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def increment(self, key, value=1):
+        row = self._row if self._pid == os.getpid() else self._claim()
+        i = row + self.index[key]
+        with self._lock:
+            self._cells[i] += value
+
+    def merge(self, counts):
+        """
+        Add a mapping of key to count to this process's row, e.g. a Counter
+        collected locally between flushes.
+        """
+        row = self._row if self._pid == os.getpid() else self._claim()
+        index, cells = self.index, self._cells
+        with self._lock:
+            for key, cnt in counts.items():
+                cells[row + index[key]] += cnt
+
+    def __getitem__(self, key):
+        i, cells, width = self.index[key], self._cells, self._width
+        return sum(cells[slot * width + i] for slot in range(self.slots))
+
+    def snapshot(self):
+        """
+        :return: Counter with the totals of all processes
+        """
+        cells, width = self._cells.tolist(), self._width
+        result = Counter()
+        for i, key in enumerate(self.keys, 1):
+            result[key] = sum(cells[i::width])
+        return result
+
+    def most_common(self, n=None):
+        return self.snapshot().most_common(n)
+
+    def close(self):
         """
-            Clears all ThreadedDict instances.
+        Detach from the shared block, the creating process also frees it.
         """
-        for t in list(ThreadedDict._instances):
-            t.clear()
+        self._cells.release()
+        self._shm.close()
+        if os.getpid() == self._owner:
+            self._shm.unlink()
+
+
+MASK_64 = (1 << 64) - 1
+
+
+def _mix64(value):
+    # murmur3 finalizer, spreads hash() of small ints over all 64 bits
+    value &= MASK_64
+    value = ((value ^ (value >> 33)) * 0xff51afd7ed558ccd) & MASK_64
+    value = ((value ^ (value >> 33)) * 0xc4ceb9fe1a85ec53) & MASK_64
+    return value ^ (value >> 33)
+
+
+class BloomFilter:
+    """
+    Fixed size set membership test. Keys are never missed, and with at most
+    `capacity` keys added a key that was not added is reported present with
+    probability about `error_rate`. Memory is
+    -capacity * ln(error_rate) / ln(2) ** 2 bits.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        if capacity < 1 or not 0 < error_rate < 1:
+            raise ValueError('capacity must be positive and error_rate between 0 and 1')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        h = _mix64(hash(key))
+        h1, h2, size = h & 0xffffffff, (h >> 32) | 1, self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        """
+        :return: True when key was not present before
+        """
+        bits, added = self._bits, False
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def __len__(self):
+        return self.count
 
-    # Define all these methods to more or less fully emulate dict -- attribute access
-    # is built into threading.local.
+
+class SpaceSaving:
+    """
+    Space-Saving top-k (Metwally et al.), memory bounded to `capacity` keys.
+
+    When a new key arrives at a full table it replaces the key with the
+    smallest count and inherits that count as its error. For N counted
+    events every monitored key satisfies count - error <= true count <= count,
+    every estimate is too high by at most N / capacity, and every key whose
+    true count exceeds N / capacity is guaranteed to be monitored.
+    """
+
+    def __init__(self, capacity=100):
+        if capacity < 1:
+            raise ValueError('capacity must be positive')
+        self.capacity = capacity
+        self.total = 0
+        self._counts = {}
+        self._errors = {}
+        # count -> keys holding it, lets the minimum be found without a scan
+        self._buckets = {}
+        self._min = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def __getitem__(self, key):
+        """
+        :return: upper bound of the count of key, 0 when not monitored
+        """
+        return self._counts.get(key, 0)
+
+    def error(self, key):
+        return self._errors.get(key, 0)
+
+    def _add(self, key, cnt):
+        self._buckets.setdefault(cnt, {})[key] = None
+
+    def _remove(self, key, cnt):
+        bucket = self._buckets[cnt]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[cnt]
+            if cnt == self._min:
+                return True
+        return False
+
+    def increment(self, key, value=1):
+        self.total += value
+        counts = self._counts
+        cnt = counts.get(key)
+        if cnt is None and len(counts) < self.capacity:
+            counts[key] = value
+            self._errors[key] = 0
+            self._add(key, value)
+            if len(counts) == 1 or value < self._min:
+                self._min = value
+            return
+        if cnt is None:
+            # replace a key holding the minimum, it becomes the new key's error
+            cnt = self._min
+            victim = next(iter(self._buckets[cnt]))
+            del counts[victim], self._errors[victim]
+            self._errors[key] = cnt
+            emptied = self._remove(victim, cnt)
+        else:
+            emptied = self._remove(key, cnt)
+        counts[key] = cnt + value
+        self._add(key, cnt + value)
+        if emptied:
+            self._min = cnt + 1 if value == 1 else min(self._buckets)
+
+    def update(self, iterable):
+        """
+        Count the elements of iterable, or add the values of a mapping.
+        """
+        counts = iterable if isinstance(iterable, abc.Mapping) else None
+        if counts is None:
+            counts = {}
+            _count_elements(counts, iterable)
+        increment = self.increment
+        for key, cnt in counts.items():
+            increment(key, cnt)
+
+    def most_common(self, n=None):
+        """
+        :return: list of (key, estimated count), highest first
+        """
+        items = self._counts.items()
+        if n is None:
+            return sorted(items, key=itemgetter(1), reverse=True)
+        return nlargest(n, items, key=itemgetter(1))
+
+    def guaranteed(self, n=None):
+        """
+        Keys whose lower bound count - error still ranks them in the top.
+        :return: list of (key, lower bound), highest first
+        """
+        items = [(key, cnt - self._errors[key]) for key, cnt in self._counts.items()]
+        items.sort(key=itemgetter(1), reverse=True)
+        return items if n is None else items[:n]
+
+    def elements(self):
+        return chain.from_iterable(starmap(repeat, self.most_common()))
+
+
+class CountMinSketch:
+    """
+    Count-Min sketch (Cormode and Muthukrishnan) in `depth` rows of `width`
+    int64 cells, memory is 8 * width * depth bytes whatever the stream.
+
+    Estimates never undercount. With width = ceil(e / epsilon) and
+    depth = ceil(ln(1 / delta)) an estimate exceeds the true count by more
+    than epsilon * N with probability at most delta, N being the total
+    counted. Keys are hashed with hash(), so sketches can only be merged
+    between processes sharing the hash seed, e.g. forked workers.
+
+    With `top` set, the `top` keys with the highest estimates seen so far are
+    tracked for most_common and elements.
+    """
+
+    def __init__(self, epsilon=0.001, delta=0.01, top=0):
+        if not 0 < epsilon < 1 or not 0 < delta < 1:
+            raise ValueError('epsilon and delta must be between 0 and 1')
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.top = top
+        self.total = 0
+        self._table = array('q', bytes(8 * self.width * self.depth))
+        self._offsets = range(0, self.width * self.depth, self.width)
+        self._heavy = {}
+        self._heavy_min = None
+
+    def _cells(self, key):
+        # double hashing: row i uses h1 + i * h2
+        h = _mix64(hash(key))
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        width = self.width
+        return [offset + (h1 + i * h2) % width for i, offset in enumerate(self._offsets)]
+
+    def increment(self, key, value=1):
+        """
+        :return: new estimate of key
+        """
+        table = self._table
+        self.total += value
+        estimate = None
+        for cell in self._cells(key):
+            cnt = table[cell] = table[cell] + value
+            if estimate is None or cnt < estimate:
+                estimate = cnt
+        if self.top:
+            self._track(key, estimate)
+        return estimate
+
+    def update(self, iterable):
+        """
+        Count the elements of iterable, or add the values of a mapping.
+        """
+        counts = iterable if isinstance(iterable, abc.Mapping) else None
+        if counts is None:
+            counts = {}
+            _count_elements(counts, iterable)
+        increment = self.increment
+        for key, cnt in counts.items():
+            increment(key, cnt)
+
+    def __getitem__(self, key):
+        table = self._table
+        return min(table[cell] for cell in self._cells(key))
+
+    def _track(self, key, estimate):
+        heavy = self._heavy
+        if key in heavy or len(heavy) < self.top:
+            heavy[key] = estimate
+            if self._heavy_min is None or key == self._heavy_min or len(heavy) == self.top:
+                self._heavy_min = min(heavy, key=heavy.get)
+        elif estimate > heavy[self._heavy_min]:
+            del heavy[self._heavy_min]
+            heavy[key] = estimate
+            self._heavy_min = min(heavy, key=heavy.get)
+
+    def merge(self, other):
+        """
+        Add another sketch of the same dimensions.
+        """
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('Sketches differ in size.')
+        table = self._table
+        for i, cnt in enumerate(other._table):
+            if cnt:
+                table[i] += cnt
+        self.total += other.total
+        if self.top:
+            for key in chain(list(self._heavy), other._heavy):
+                self._track(key, self[key])
+        return self
+
+    def most_common(self, n=None):
+        """
+        :return: list of (key, estimated count) of tracked keys, highest first
+        """
+        items = sorted(((key, self[key]) for key in self._heavy), key=itemgetter(1), reverse=True)
+        return items if n is None else items[:n]
+
+    def elements(self):
+        return chain.from_iterable(starmap(repeat, self.most_common()))
+
+
+class RequestNamespace:
+    """
+    Values of one request context. They are stored as instance attributes, so
+    reading `ns.user` is a plain attribute lookup; item access and the dict
+    methods work on the same values.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(*args, **kwargs)
 
     def __getitem__(self, key):
         return self.__dict__[key]
@@ -550,7 +1474,18 @@ class ThreadedDict(local):
     def __contains__(self, key):
         return key in self.__dict__
 
-    has_key = __contains__
+    def __iter__(self):
+        return iter(self.__dict__)
+
+    def __len__(self):
+        return len(self.__dict__)
+
+    def __eq__(self, other):
+        if isinstance(other, RequestNamespace):
+            other = other.__dict__
+        return self.__dict__ == other
+
+    __hash__ = None
 
     def clear(self):
         self.__dict__.clear()
@@ -568,7 +1503,7 @@ class ThreadedDict(local):
         return self.__dict__.keys()
 
     def values(self):
-        return self.__dict__.values
+        return self.__dict__.values()
 
     def pop(self, key, *args):
         return self.__dict__.pop(key, *args)
@@ -583,6 +1518,152 @@ class ThreadedDict(local):
         self.__dict__.update(*args, **kwargs)
 
     def __repr__(self):
-        return 'ThreadedDict {}'.format(local.__repr__(self))
+        return 'RequestNamespace {!r}'.format(self.__dict__)
+
+
+class RequestContext:
+    """
+    Per request key/value store on a ContextVar, dict and attribute access.
+    Threads, forked workers and asyncio tasks each see their own values, as
+    long as every request starts with reset() or runs inside scope(): both
+    bind a fresh RequestNamespace in O(1), nothing is registered globally.
+
+    current() returns that namespace and is the access path for hot code:
+    fetch it once per handler and read `ns.user` at plain attribute speed.
+    Attribute access on the context itself is a convenience that goes through
+    __getattr__ on every read; ThreadedDict is the variant tuned for it.
+    """
+    __slots__ = ('_var',)
+
+    def __init__(self, name='waffle.request'):
+        object.__setattr__(self, '_var', ContextVar(name))
+
+    def current(self):
+        """
+        :return: RequestNamespace of the current context
+        """
+        return _current(self)
+
+    def reset(self):
+        """
+        Bind an empty namespace for the request starting in this context.
+        :return: token for restore()
+        """
+        return _context_var(self).set(RequestNamespace())
+
+    def restore(self, token):
+        _context_var(self).reset(token)
+
+    @contextmanager
+    def scope(self):
+        var = _context_var(self)
+        token = var.set(RequestNamespace())
+        try:
+            yield self
+        finally:
+            var.reset(token)
+
+    def __getattr__(self, key):
+        try:
+            return _current(self).__dict__[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key, value):
+        _current(self).__dict__[key] = value
+
+    def __delattr__(self, key):
+        try:
+            del _current(self).__dict__[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __getitem__(self, key):
+        return _current(self)[key]
+
+    def __setitem__(self, key, value):
+        _current(self)[key] = value
+
+    def __delitem__(self, key):
+        del _current(self)[key]
+
+    def __contains__(self, key):
+        return key in _current(self)
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(_current(self))
+
+    def __len__(self):
+        return len(_current(self))
+
+    def clear(self):
+        _current(self).clear()
+
+    def copy(self):
+        return _current(self).copy()
+
+    def get(self, key, default=None):
+        return _current(self).get(key, default)
+
+    def items(self):
+        return _current(self).items()
+
+    def keys(self):
+        return _current(self).keys()
+
+    def values(self):
+        return _current(self).values()
+
+    def pop(self, key, *args):
+        return _current(self).pop(key, *args)
+
+    def popitem(self):
+        return _current(self).popitem()
+
+    def setdefault(self, key, default=None):
+        return _current(self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        _current(self).update(*args, **kwargs)
+
+    def __repr__(self):
+        return '{} {!r}'.format(type(self).__name__, _current(self).__dict__)
 
     __str__ = __repr__
+
+
+_context_var = RequestContext._var.__get__
+
+
+def _current(context):
+    var = _context_var(context)
+    try:
+        return var.get()
+    except LookupError:
+        ns = RequestNamespace()
+        var.set(ns)
+        return ns
+
+
+class ThreadedDict(RequestContext):
+    """
+    RequestContext for code written against the thread local version, which
+    reads values as attributes. Values are looked up before the class: a
+    failed normal lookup that falls through to __getattr__ costs several
+    times the read itself, while method lookups here pay one extra call.
+    """
+    __slots__ = ()
+
+    def __getattribute__(self, key):
+        if key in _THREADED_DICT_ATTRS:
+            return _object_getattribute(self, key)
+        try:
+            return _context_var(self).get().__dict__[key]
+        except (LookupError, KeyError):
+            raise AttributeError(key) from None
+
+
+_object_getattribute = object.__getattribute__
+_THREADED_DICT_ATTRS = frozenset(dir(ThreadedDict))